@@ -5,8 +5,14 @@ from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
 from pydantic import BaseModel
+import hashlib
 import os
-from db import get_db_connection
+import time
+from cache import TTLCache
+import metrics
+import timing
+from db import run_db
+from users import get_user_by_email, get_cached_user_by_email
 
 # JWT configuration from environment
 SECRET_KEY = os.getenv("SECRET_KEY")
@@ -14,43 +20,67 @@ ALGORITHM = os.getenv("ALGORITHM")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# sha256(token) -> email for tokens that already passed jwt.decode. Entries
+# expire with the token; the user itself is resolved through the user cache,
+# so users.invalidate_user() still takes effect immediately.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+_verified_tokens = TTLCache(maxsize=TOKEN_CACHE_SIZE)
+
 class TokenData(BaseModel):
     email: Optional[str] = None
 
-def get_user_by_email(email: str):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    try:
-        cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-        user = cursor.fetchone()
-        return user
-    finally:
-        cursor.close()
-        conn.close()
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def verify_token(token: str):
-    """Verify JWT token - used for WebSocket authentication"""
+def decode_token_email(token: str) -> Optional[str]:
+    """Return the token's subject, decoding each distinct token only once.
+
+    Raises JWTError for invalid or expired tokens.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    email = _verified_tokens.get(key)
+    if email is not None:
+        metrics.jwt_cache_lookups.labels("hit").inc()
+        return email
+    metrics.jwt_cache_lookups.labels("miss").inc()
+
+    with metrics.jwt_decode_seconds.time(), timing.span("jwt"):
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    email = payload.get("sub")
+    if email:
+        ttl = payload.get("exp", 0) - time.time()
+        if ttl > 0:
+            _verified_tokens.set(key, email, ttl=ttl)
+    return email
+
+async def _load_user(email: str):
+    user = get_cached_user_by_email(email)
+    if user is None:
+        user = await run_db(get_user_by_email, email)
+    return user
+
+async def authenticate_token(token: str):
+    """Verify a JWT for WebSocket authentication; hot tokens resolve without crypto or a DB round trip"""
     try:
         if not token:
             return None
-            
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
+
+        email = decode_token_email(token)
         if not email:
             return None
-        
-        user = get_user_by_email(email)
-        return user
+
+        return await _load_user(email)
     except JWTError:
         return None
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    with timing.span("auth"):
+        return await _resolve_current_user(token)
+
+async def _resolve_current_user(token: str):
     # print(f"get_current_user called with token: {token[:20] + '...' if token else 'None'}")
     
     credentials_exception = HTTPException(
@@ -64,8 +94,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
         
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
+        email = decode_token_email(token)
         # print(f"Token decoded successfully for email: {email}")
         
         if not email:
@@ -77,7 +106,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         # print(f"JWT Error: {e}")
         raise credentials_exception
 
-    user = get_user_by_email(email=token_data.email)
+    user = await _load_user(token_data.email)
     if not user:
         # print(f"No user found for email: {token_data.email}")
         raise credentials_exception
@@ -88,4 +117,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 async def get_current_active_user(current_user: dict = Depends(get_current_user)):
     if current_user.get('disabled'):
         raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
\ No newline at end of file
+    return current_user
+
+
+def token_cache_stats() -> dict:
+    return _verified_tokens.stats()
@@ -0,0 +1,361 @@
+# bench/bench_queries.py
+"""Timings and EXPLAIN plans of the chat/utils.py queries at growing data sizes.
+
+For every --sizes entry (number of chat_messages rows) a scratch schema on
+the MySQL server from .env is filled with synthetic users, rooms and
+messages, then each query is timed on hot, typical and cold inputs and its
+plan captured. Room traffic and user activity follow Zipf distributions, so
+a few rooms hold most messages and most rooms have only a handful.
+
+    python bench/bench_queries.py --sizes 10k,100k,1m --output before.json
+    python bench/bench_queries.py --sizes 10k,100k,1m --compare before.json
+
+Sizes accept k and m suffixes, up to 10m.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+SYLLABLES = ["ka", "ri", "to", "mi", "sa", "lo", "ne", "zu", "be", "xo", "chi", "ran", "dex", "vo", "lin", "mar"]
+INSERT_BATCH = 5000
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+def zipf_cum_weights(n: int, s: float) -> List[float]:
+    return list(itertools.accumulate(1 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def username(rng: random.Random, i: int) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + str(i)
+
+
+# -- Dataset ------------------------------------------------------------------------
+
+def reset_schema(db_name: str):
+    import mysql.connector
+
+    conn = mysql.connector.connect(
+        host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD")
+    )
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{db_name}`")
+    cursor.execute(f"CREATE DATABASE `{db_name}`")
+    conn.close()
+
+
+def bulk_insert(sql: str, rows: list):
+    from db import db_cursor
+
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("SET SESSION unique_checks = 0, foreign_key_checks = 0")
+        try:
+            cursor.executemany(sql, rows)
+        finally:
+            # Pooled connections keep session settings
+            cursor.execute("SET SESSION unique_checks = 1, foreign_key_checks = 1")
+
+
+def generate(size: int, seed: int) -> dict:
+    """Fill the (empty) schema with `size` messages; returns ids worth probing"""
+    from db import db_cursor, get_pool
+    from schema import migrate
+    from chat.utils import backfill_room_summaries, reconcile_unread_counters
+
+    get_pool().dispose()
+    migrate()
+    rng = random.Random(seed)
+    n_users = max(200, size // 200)
+    n_rooms = max(100, size // 100)
+
+    # Active users take part in far more rooms than the long tail
+    user_weights = zipf_cum_weights(n_users, 1.0)
+    pairs = set()
+    while len(pairs) < n_rooms:
+        a = rng.choices(range(1, n_users + 1), cum_weights=user_weights)[0]
+        b = rng.randint(1, n_users)
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+    rooms = sorted(pairs)
+    rng.shuffle(rooms)
+
+    for start in range(1, n_users + 1, INSERT_BATCH):
+        bulk_insert(
+            "INSERT INTO users (id, username, email, hashed_password) VALUES (%s, %s, %s, %s)",
+            [(i, username(rng, i), f"user{i}@bench.invalid", "x")
+             for i in range(start, min(start + INSERT_BATCH, n_users + 1))]
+        )
+    for start in range(0, n_rooms, INSERT_BATCH):
+        bulk_insert(
+            "INSERT INTO chat_rooms (id, user1_id, user2_id) VALUES (%s, %s, %s)",
+            [(i + 1, *rooms[i]) for i in range(start, min(start + INSERT_BATCH, n_rooms))]
+        )
+
+    # Room traffic: a few hot rooms, a long tail of quiet ones
+    room_weights = zipf_cum_weights(n_rooms, 1.1)
+    first_time = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / size
+    message_id = 0
+    while message_id < size:
+        batch = []
+        for room_index in rng.choices(range(n_rooms), cum_weights=room_weights, k=min(INSERT_BATCH, size - message_id)):
+            message_id += 1
+            batch.append((
+                message_id, room_index + 1, rng.choice(rooms[room_index]),
+                f"message {message_id} " + " ".join(rng.choices(SYLLABLES, k=rng.randint(2, 20))),
+                first_time + step * message_id,
+            ))
+        bulk_insert(
+            "INSERT INTO chat_messages (id, room_id, sender_id, message, created_at) VALUES (%s, %s, %s, %s, %s)",
+            batch
+        )
+
+    backfill_room_summaries()
+    with db_cursor(commit=True) as cursor:
+        # Most participants are caught up; the rest stopped somewhere in the room
+        cursor.execute("""
+            INSERT IGNORE INTO user_chat_status (user_id, room_id, last_read_message_id)
+            SELECT p.user_id, s.room_id,
+                   IF(RAND(%s) < 0.7, s.last_message_id, FLOOR(s.last_message_id * RAND()))
+            FROM chat_room_summary s
+            JOIN (SELECT id, user1_id AS user_id FROM chat_rooms
+                  UNION ALL
+                  SELECT id, user2_id FROM chat_rooms) p ON p.id = s.room_id
+        """, (seed,))
+    reconcile_unread_counters()
+    with db_cursor() as cursor:
+        cursor.execute("ANALYZE TABLE users, chat_rooms, chat_messages, user_chat_status, chat_room_summary")
+        cursor.fetchall()
+
+    return probes(rooms)
+
+
+def probes(rooms: List[Tuple[int, int]]) -> dict:
+    """Hot, typical and cold rooms and users to run the queries with"""
+    from db import db_cursor
+
+    with db_cursor() as cursor:
+        cursor.execute("SELECT room_id, message_count, last_message_id FROM chat_room_summary ORDER BY message_count DESC")
+        by_traffic = cursor.fetchall()
+        cursor.execute("SELECT username FROM users WHERE id = 1")
+        hot_name = cursor.fetchone()[0]
+
+    rooms_per_user: Dict[int, int] = {}
+    for pair in rooms:
+        for user_id in pair:
+            rooms_per_user[user_id] = rooms_per_user.get(user_id, 0) + 1
+    by_rooms = sorted(rooms_per_user, key=rooms_per_user.get, reverse=True)
+
+    hot, typical, cold = by_traffic[0], by_traffic[len(by_traffic) // 2], by_traffic[-1]
+    return {
+        "hot_room": hot[0], "hot_room_messages": hot[1], "hot_room_middle_id": hot[2] // 2,
+        "hot_room_last_id": hot[2],
+        "typical_room": typical[0], "cold_room": cold[0], "cold_room_last_id": cold[2],
+        "hot_room_user": rooms[hot[0] - 1][0], "cold_room_user": rooms[cold[0] - 1][0],
+        "hot_user": by_rooms[0], "hot_user_rooms": rooms_per_user[by_rooms[0]],
+        "typical_user": by_rooms[len(by_rooms) // 2],
+        "search_common": SYLLABLES[0], "search_prefix": hot_name[:4], "search_rare": hot_name,
+    }
+
+
+# -- Measurement ----------------------------------------------------------------------
+
+class RecordingCursor:
+    """Passes everything to the real cursor, remembering each statement"""
+
+    def __init__(self, cursor, statements: List[Tuple[str, tuple]]):
+        self._cursor = cursor
+        self._statements = statements
+
+    def execute(self, sql, params=None, *args, **kwargs):
+        self._statements.append((sql, params))
+        return self._cursor.execute(sql, params, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@contextmanager
+def recording(statements: List[Tuple[str, tuple]]):
+    """Record the SQL the chat and user functions run, by wrapping their db_cursor"""
+    import chat.utils
+    import users
+
+    real = chat.utils.db_cursor
+
+    @contextmanager
+    def db_cursor(*args, **kwargs):
+        with real(*args, **kwargs) as cursor:
+            yield RecordingCursor(cursor, statements)
+
+    chat.utils.db_cursor = users.db_cursor = db_cursor
+    try:
+        yield
+    finally:
+        chat.utils.db_cursor = users.db_cursor = real
+
+
+def explain(statements: List[Tuple[str, tuple]]) -> List[dict]:
+    from db import db_cursor
+
+    plans = []
+    with db_cursor(dictionary=True) as cursor:
+        for sql, params in statements:
+            if sql.lstrip().split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "INSERT", "DELETE"):
+                continue
+            cursor.execute("EXPLAIN " + sql, params)
+            plans.append({
+                "sql": " ".join(sql.split()),
+                "plan": [{key: row.get(key) for key in ("table", "type", "key", "rows", "filtered", "Extra")}
+                         for row in cursor.fetchall()],
+            })
+    return plans
+
+
+def mark_read(room_id: int, user_id: int, first_id: int, last_id: int) -> Callable[[], object]:
+    """mark_room_read plus the flush that writes it.
+
+    Each call moves the marker a step further, so save_read_positions counts
+    newly read messages rather than finding the marker already there.
+    """
+    from chat.utils import get_room_last_message_id, save_read_positions
+
+    step = max(1, (last_id - first_id) // 32)
+    marks = itertools.chain(range(first_id + step, last_id, step), itertools.repeat(last_id))
+
+    def call():
+        target = min(next(marks), get_room_last_message_id(room_id))
+        save_read_positions([(user_id, room_id, target)])
+
+    return call
+
+
+def cases(p: dict) -> Dict[str, Callable[[], object]]:
+    from chat.utils import (
+        get_chat_history, get_user_chat_list, get_total_unread_count,
+        search_users_by_username,
+    )
+
+    return {
+        "history latest / hot room": lambda: get_chat_history(p["hot_room"]),
+        "history latest / typical": lambda: get_chat_history(p["typical_room"]),
+        "history latest / cold room": lambda: get_chat_history(p["cold_room"]),
+        "history deep page / hot": lambda: get_chat_history(p["hot_room"], p["hot_room_middle_id"]),
+        "chat list / hot user": lambda: get_user_chat_list(p["hot_user"]),
+        "chat list / typical user": lambda: get_user_chat_list(p["typical_user"]),
+        "total unread / hot user": lambda: get_total_unread_count(p["hot_user"]),
+        "search / 2 chars": lambda: search_users_by_username(p["search_common"], 0),
+        "search / 4 char prefix": lambda: search_users_by_username(p["search_prefix"], 0),
+        "search / full name": lambda: search_users_by_username(p["search_rare"], 0),
+        "mark read / hot room": mark_read(p["hot_room"], p["hot_room_user"],
+                                          p["hot_room_middle_id"], p["hot_room_last_id"]),
+        "mark read / cold room": mark_read(p["cold_room"], p["cold_room_user"], 0, p["cold_room_last_id"]),
+    }
+
+
+def measure(p: dict, repeat: int) -> Dict[str, dict]:
+    results = {}
+    for name, call in cases(p).items():
+        statements: List[Tuple[str, tuple]] = []
+        with recording(statements):
+            call()  # also warms the buffer pool for this input
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        results[name] = {
+            "median_ms": statistics.median(timings),
+            "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            "explain": explain(statements),
+        }
+    return results
+
+
+# -- Report -------------------------------------------------------------------------
+
+def print_report(report: dict, baseline: dict = None):
+    sizes = list(report["sizes"])
+    names = list(next(iter(report["sizes"].values()))["queries"])
+    header = f"{'median ms':<28}" + "".join(f"{size:>16}" for size in sizes)
+    print(header)
+    print("-" * len(header))
+    for name in names:
+        row = f"{name:<28}"
+        for size in sizes:
+            median = report["sizes"][size]["queries"][name]["median_ms"]
+            cell = f"{median:.2f}"
+            old = (baseline or {}).get("sizes", {}).get(size, {}).get("queries", {}).get(name)
+            if old:
+                cell += f" ({median / old['median_ms']:.2f}x)"
+            row += f"{cell:>16}"
+        print(row)
+
+    # Plans that read more than a few pages of rows are the ones to look at
+    print()
+    for size in sizes:
+        for name, result in report["sizes"][size]["queries"].items():
+            for statement in result["explain"]:
+                for step in statement["plan"]:
+                    if step["type"] == "ALL" or (step["rows"] or 0) > 10_000:
+                        print(f"[{size}] {name}: {step['table']} type={step['type']} key={step['key']} "
+                              f"rows={step['rows']} {step['Extra'] or ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k,100k,1m", help="comma separated message counts")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per query")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db-name", help="scratch schema (default <DB_NAME>_bench)")
+    parser.add_argument("--output", help="write the full report, plans included, as JSON")
+    parser.add_argument("--compare", help="earlier --output to show ratios against")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(ROOT, ".env"))
+    db_name = args.db_name or f"{os.getenv('DB_NAME', 'coinconnect')}_bench"
+    # Before the db module is imported, so the pool connects to the scratch schema
+    os.environ["DB_NAME"] = db_name
+    # Time the queries, not the search result cache
+    os.environ["USERNAME_SEARCH_TTL"] = "0"
+
+    report = {"created": datetime.now().isoformat(timespec="seconds"), "seed": args.seed, "sizes": {}}
+    for size in (parse_size(text) for text in args.sizes.split(",")):
+        reset_schema(db_name)
+        started = time.perf_counter()
+        p = generate(size, args.seed)
+        print(f"{size:,} messages generated in {time.perf_counter() - started:.0f}s "
+              f"(hot room {p['hot_room_messages']:,} messages, hot user in {p['hot_user_rooms']:,} rooms)")
+        report["sizes"][str(size)] = {"probes": p, "queries": measure(p, args.repeat)}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print()
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
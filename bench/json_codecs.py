@@ -0,0 +1,94 @@
+# bench/json_codecs.py
+"""Encode/decode cost of the JSON codecs on chat payload shapes.
+
+Compares the stdlib json.dumps the frames used before, the stdlib fallback
+in codec.py and orjson (skipped if not installed) on a chat frame, a
+history batch, a conversation list and an inbound client frame.
+
+    python bench/json_codecs.py --number 20000
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import encode_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def payloads() -> dict:
+    now = datetime.datetime(2025, 6, 1, 12, 30, 15, 123456)
+    text = "gm! did the transfer go through? sending the rest tonight 🚀"
+    chat = {
+        "type": "chat", "data": text, "senderId": 1042, "senderUsername": "satoshi_fan",
+        "timestamp": None, "id": 9182736, "roomId": 5531, "isMe": False,
+    }
+    history = {
+        "type": "history_batch",
+        "messages": [{
+            "type": "history", "isMe": i % 2 == 0, "data": text, "senderId": 1042 + i % 2,
+            "senderUsername": "satoshi_fan", "timestamp": now - datetime.timedelta(minutes=i),
+            "id": 9182736 - i,
+        } for i in range(100)],
+        "final": True,
+    }
+    conversations = {
+        "conversations": [{
+            "room_id": 5531 + i, "other_user_id": 2000 + i, "other_username": f"trader_{i}",
+            "other_email": f"trader_{i}@example.com", "last_message": text,
+            "last_message_time": now - datetime.timedelta(hours=i), "unread_count": i % 7,
+        } for i in range(50)],
+    }
+    return {"chat": chat, "history_batch": history, "conversations": conversations}
+
+
+def stdlib_before(obj) -> str:
+    # What the code did before: timestamps formatted by hand, default json.dumps
+    return json.dumps(obj, default=lambda value: value.isoformat())
+
+
+def candidates() -> dict:
+    encoder = json.JSONEncoder(default=encode_default, ensure_ascii=False, separators=(",", ":"))
+    codecs = {
+        "json (before)": (stdlib_before, json.loads),
+        "json (codec)": (encoder.encode, json.loads),
+    }
+    if orjson is not None:
+        codecs["orjson (codec)"] = (lambda obj: orjson.dumps(obj, default=encode_default).decode(), orjson.loads)
+    return codecs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20_000, help="calls per measurement")
+    args = parser.parse_args()
+
+    shapes = payloads()
+    inbound = json.dumps({"message": shapes["chat"]["data"]})
+    codecs = candidates()
+    if orjson is None:
+        print("orjson is not installed; comparing the stdlib only\n")
+
+    print(f"{'payload':<16}{'codec':<18}{'encode':>12}{'decode':>12}{'bytes':>8}")
+    for shape, obj in shapes.items():
+        for name, (dumps, loads) in codecs.items():
+            text = dumps(obj)
+            encode = min(timeit.repeat(lambda: dumps(obj), number=args.number, repeat=3)) / args.number
+            decode = min(timeit.repeat(lambda: loads(text), number=args.number, repeat=3)) / args.number
+            print(f"{shape:<16}{name:<18}{encode * 1e6:>10.2f}us{decode * 1e6:>10.2f}us{len(text.encode()):>8}")
+
+    for name, (_, loads) in codecs.items():
+        decode = min(timeit.repeat(lambda: loads(inbound), number=args.number, repeat=3)) / args.number
+        print(f"{'inbound frame':<16}{name:<18}{'':>12}{decode * 1e6:>10.2f}us{len(inbound.encode()):>8}")
+
+
+if __name__ == "__main__":
+    main()
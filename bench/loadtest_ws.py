@@ -0,0 +1,337 @@
+# bench/loadtest_ws.py
+"""End-to-end load test of /ws: registration, login, connect and chat fan-out.
+
+Registers --users users through /register and /token, pairs them into
+--rooms chat rooms, opens --connections sockets spread over those rooms and
+sends chat messages at --rate per second for --duration seconds. Reports
+connect latency, delivery latency (send to arrival on the other
+participants' sockets) and error counts.
+
+Point it at a running server with --url, or let it start one with --serve:
+that creates a scratch schema (<DB_NAME>_loadtest by default) on the MySQL
+server from .env, migrates it, runs uvicorn against it and drops it afterwards, so
+results from runs before and after a change are comparable.
+
+    python bench/loadtest_ws.py --serve --users 200 --connections 400 --rooms 100 --rate 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+MARKER = "loadtest"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(name: str, seconds: List[float]) -> str:
+    ms = [value * 1000 for value in seconds]
+    return (f"{name:<22}n={len(ms):<8}p50={percentile(ms, 50):8.2f}ms  "
+            f"p99={percentile(ms, 99):8.2f}ms  max={max(ms, default=float('nan')):8.2f}ms")
+
+
+class Stats:
+    def __init__(self):
+        self.connect_latency: List[float] = []
+        self.delivery_latency: List[float] = []
+        self.connect_errors = 0
+        self.send_errors = 0
+        self.unexpected_closes = 0
+        self.sent = 0
+        self.echoes = 0
+        self.delivered = 0
+        self.expected = 0
+
+
+# -- HTTP setup (blocking, run on a thread pool) --------------------------------
+
+# /register and /token answer 503 with Retry-After once the server's bcrypt
+# queue (HASH_MAX_PENDING) is full, which --setup-concurrency can exceed on
+# small hosts; those are retried rather than failing the run
+SETUP_RETRY_SECONDS = 120
+
+
+def _request(url: str, data: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> dict:
+    deadline = time.monotonic() + SETUP_RETRY_SECONDS
+    while True:
+        request = urllib.request.Request(url, data=data, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return json.loads(response.read() or b"null")
+        except urllib.error.HTTPError as e:
+            if e.code != 503 or time.monotonic() >= deadline:
+                raise
+            try:
+                delay = float(e.headers.get("Retry-After") or 1)
+            except ValueError:
+                delay = 1.0
+            # Jittered so a burst of rejected requests does not return in step
+            time.sleep(delay * random.uniform(1, 1.5))
+
+
+def create_account(base_url: str, run_id: str, index: int) -> dict:
+    username = f"lt{run_id}_{index}"
+    email = f"{username}@loadtest.invalid"
+    password = f"pw-{run_id}-{index}"
+    _request(f"{base_url}/register", json.dumps({
+        "username": username, "email": email, "password": password
+    }).encode(), {"Content-Type": "application/json"})
+    token = _request(f"{base_url}/token", urllib.parse.urlencode({
+        "username": email, "password": password
+    }).encode(), {"Content-Type": "application/x-www-form-urlencoded"})["access_token"]
+    me = _request(f"{base_url}/users/me", headers={"Authorization": f"Bearer {token}"})
+    return {"id": me["id"], "token": token}
+
+
+async def create_accounts(base_url: str, count: int, concurrency: int) -> List[dict]:
+    run_id = uuid.uuid4().hex[:8]
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(concurrency) as pool:
+        return await asyncio.gather(*[
+            loop.run_in_executor(pool, create_account, base_url, run_id, i) for i in range(count)
+        ])
+
+
+# -- Sockets ----------------------------------------------------------------------
+
+class Client:
+    def __init__(self, user: dict, peer: dict, room: int):
+        self.user = user
+        self.peer = peer
+        self.room = room
+        self.socket = None
+        self.reader: Optional[asyncio.Task] = None
+
+    async def connect(self, ws_url: str, stats: Stats):
+        query = urllib.parse.urlencode({
+            "userId": self.user["id"], "recipientId": self.peer["id"],
+            "token": self.user["token"], "protocol": 2,
+        })
+        started = time.perf_counter()
+        try:
+            self.socket = await websockets.connect(f"{ws_url}/ws?{query}", max_size=None, open_timeout=30)
+            # Connected once history has been sent and the info frame arrives
+            while json.loads(await self.socket.recv()).get("type") != "info":
+                pass
+        except Exception:
+            stats.connect_errors += 1
+            self.socket = None
+            return
+        stats.connect_latency.append(time.perf_counter() - started)
+
+    async def read(self, stats: Stats, closing: asyncio.Event):
+        try:
+            async for frame in self.socket:
+                message = json.loads(frame)
+                if message.get("type") != "chat":
+                    continue
+                marker, _, sent_at = str(message.get("data", "")).partition(" ")
+                if marker != MARKER:
+                    continue
+                if message.get("isMe"):
+                    stats.echoes += 1
+                else:
+                    stats.delivered += 1
+                    stats.delivery_latency.append(time.perf_counter() - float(sent_at))
+        except websockets.ConnectionClosed:
+            pass
+        if not closing.is_set():
+            stats.unexpected_closes += 1
+
+    async def send(self, stats: Stats) -> bool:
+        try:
+            await self.socket.send(json.dumps({"message": f"{MARKER} {time.perf_counter():.9f}"}))
+        except Exception:
+            stats.send_errors += 1
+            return False
+        stats.sent += 1
+        return True
+
+
+async def drive(clients: List[Client], rate: float, duration: float, stats: Stats):
+    """Send `rate` messages per second from random open sockets, on a fixed schedule"""
+    sockets_per_room: Dict[int, int] = {}
+    for client in clients:
+        sockets_per_room[client.room] = sockets_per_room.get(client.room, 0) + 1
+
+    interval = 1 / rate
+    started = time.perf_counter()
+    sends = []
+    n = 0
+    while True:
+        due = started + n * interval
+        if due - started >= duration:
+            break
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        client = random.choice(clients)
+        # Every other socket in the room should see it
+        stats.expected += sockets_per_room[client.room] - 1
+        sends.append(asyncio.create_task(client.send(stats)))
+        n += 1
+    await asyncio.gather(*sends)
+    return time.perf_counter() - started
+
+
+# -- Stand-in server -------------------------------------------------------------
+
+def start_server(port: int, db_name: str) -> subprocess.Popen:
+    import mysql.connector
+
+    conn = mysql.connector.connect(
+        host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD")
+    )
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{db_name}`")
+    cursor.execute(f"CREATE DATABASE `{db_name}`")
+    conn.close()
+
+    env = {**os.environ, "DB_NAME": db_name}
+    subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Server did not come up within 60s")
+
+
+def stop_server(server: subprocess.Popen, db_name: str, keep_db: bool):
+    import mysql.connector
+
+    server.terminate()
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+    if not keep_db:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD")
+        )
+        conn.cursor().execute(f"DROP DATABASE IF EXISTS `{db_name}`")
+        conn.close()
+
+
+# -- Main --------------------------------------------------------------------------
+
+async def run(args):
+    base_url = args.url.rstrip("/")
+    ws_url = "ws" + base_url[len("http"):]
+    stats = Stats()
+
+    started = time.perf_counter()
+    users = await create_accounts(base_url, args.users, args.setup_concurrency)
+    print(f"registered {len(users)} users in {time.perf_counter() - started:.1f}s")
+
+    # Room r is shared by users 2r and 2r+1; sockets alternate between the two
+    rooms = [(users[2 * r], users[2 * r + 1]) for r in range(args.rooms)]
+    clients = []
+    for i in range(args.connections):
+        room = i % args.rooms
+        a, b = rooms[room]
+        clients.append(Client(a, b, room) if (i // args.rooms) % 2 == 0 else Client(b, a, room))
+
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client: Client):
+        async with semaphore:
+            await client.connect(ws_url, stats)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[connect(client) for client in clients])
+    connected = [client for client in clients if client.socket is not None]
+    print(f"opened {len(connected)}/{len(clients)} sockets in {time.perf_counter() - started:.1f}s")
+    if not connected:
+        return stats
+
+    closing = asyncio.Event()
+    for client in connected:
+        client.reader = asyncio.create_task(client.read(stats, closing))
+
+    elapsed = await drive(connected, args.rate, args.duration, stats)
+    # Give in-flight messages time to arrive
+    await asyncio.sleep(args.drain)
+
+    closing.set()
+    await asyncio.gather(*[client.socket.close() for client in connected], return_exceptions=True)
+    await asyncio.gather(*[client.reader for client in connected], return_exceptions=True)
+
+    print()
+    print(summarize("connect", stats.connect_latency))
+    print(summarize("delivery", stats.delivery_latency))
+    print(f"{'messages sent':<22}{stats.sent} ({stats.sent / elapsed:.0f}/s, target {args.rate:.0f}/s)")
+    print(f"{'deliveries':<22}{stats.delivered}/{stats.expected} "
+          f"({100 * stats.delivered / max(stats.expected, 1):.2f}%), echoes {stats.echoes}/{stats.sent}")
+    print(f"{'errors':<22}connect={stats.connect_errors} send={stats.send_errors} "
+          f"unexpected_close={stats.unexpected_closes}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8001", help="server to test")
+    parser.add_argument("--serve", action="store_true", help="start a server on a scratch schema")
+    parser.add_argument("--port", type=int, default=8765, help="port for --serve")
+    parser.add_argument("--db-name", help="scratch schema for --serve (default <DB_NAME>_loadtest)")
+    parser.add_argument("--keep-db", action="store_true", help="keep the scratch schema afterwards")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=200, help="messages per second, all sockets")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for late deliveries")
+    parser.add_argument("--setup-concurrency", type=int, default=16)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.users < 2 * args.rooms:
+        parser.error("--users must be at least twice --rooms")
+
+    server = None
+    if args.serve:
+        from dotenv import load_dotenv
+        load_dotenv(os.path.join(ROOT, ".env"))
+        db_name = args.db_name or f"{os.getenv('DB_NAME', 'coinconnect')}_loadtest"
+        server = start_server(args.port, db_name)
+        args.url = f"http://127.0.0.1:{args.port}"
+    try:
+        stats = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            stop_server(server, db_name, args.keep_db)
+    failed = stats.connect_errors or stats.send_errors or stats.unexpected_closes
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
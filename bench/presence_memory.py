@@ -0,0 +1,88 @@
+# bench/presence_memory.py
+"""Memory per connection and presence lookup cost of ConnectionManager.
+
+Registers simulated sockets (no network, no database) spread over rooms and
+reports the traced memory each one costs once its writer task is idle, then
+times is_user_in_room.
+
+    python bench/presence_memory.py --connections 100000 --rooms 50000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.bus import LocalBus
+from chat.websocket import ConnectionManager
+
+
+class FakeWebSocket:
+    __slots__ = ()
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+
+async def run(connections: int, rooms: int, lookups: int):
+    manager = ConnectionManager(bus=LocalBus())
+    await manager.start()
+
+    sockets = [FakeWebSocket() for _ in range(connections)]
+    # Two users per room, like the 1:1 chats in production
+    members = [(room * 2 + i % 2, room) for i, room in enumerate(random.choices(range(rooms), k=connections))]
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+    for websocket, (user_id, room_id) in zip(sockets, members):
+        await manager.connect_user(websocket, user_id, room_id)
+    connect_seconds = time.perf_counter() - started
+
+    # Let every writer task run until it parks on its wake-up future
+    for _ in range(3):
+        await asyncio.sleep(0)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    probes = [(random.randrange(rooms * 2), random.randrange(rooms)) for _ in range(lookups)]
+    started = time.perf_counter()
+    hits = sum(manager.is_user_in_room(user_id, room_id) for user_id, room_id in probes)
+    lookup_seconds = time.perf_counter() - started
+
+    print(f"connections:            {connections}")
+    print(f"rooms:                  {rooms}")
+    print(f"traced memory:          {(after - before) / 2**20:.1f} MiB (peak {(peak - before) / 2**20:.1f} MiB)")
+    print(f"bytes per connection:   {(after - before) / connections:.0f}")
+    print(f"connect_user:           {connect_seconds / connections * 1e6:.2f} us each")
+    print(f"is_user_in_room:        {lookup_seconds / lookups * 1e9:.0f} ns each ({hits} hits / {lookups})")
+
+    for websocket in sockets:
+        await manager.disconnect_user(websocket)
+    await manager.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=100_000)
+    parser.add_argument("--rooms", type=int, default=50_000)
+    parser.add_argument("--lookups", type=int, default=1_000_000)
+    args = parser.parse_args()
+    asyncio.run(run(args.connections, args.rooms, args.lookups))
+
+
+if __name__ == "__main__":
+    main()
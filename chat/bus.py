@@ -0,0 +1,138 @@
+# chat/bus.py
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Optional, Set
+import codec
+
+logger = logging.getLogger(__name__)
+
+# handler(channel, event) delivers an event to this worker's own sockets.
+# Channels are "room:<id>" and "user:<id>"; ConnectionManager subscribes to
+# one when its first socket there connects and unsubscribes after the last.
+Handler = Callable[[str, dict], Awaitable[None]]
+
+
+class LocalBus:
+    """In-process bus: a publish is delivered straight to this worker's sockets"""
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+
+    async def subscribe(self, channel: str):
+        # Every publish comes from this worker, so there is nothing to narrow
+        pass
+
+    async def unsubscribe(self, channel: str):
+        pass
+
+    async def publish(self, channel: str, event: dict):
+        if self._handler is not None:
+            await self._handler(channel, event)
+
+    async def stop(self):
+        self._handler = None
+
+
+class RedisBus:
+    """Redis pub/sub bus so room and user fan-out reaches every worker and node.
+
+    Each worker subscribes only to the room and user channels it holds
+    sockets for, so it never receives or decodes traffic it cannot deliver.
+    `client` may be any object with the redis.asyncio publish()/pubsub() API,
+    so tests can pass a local stand-in instead of a server.
+    """
+
+    def __init__(self, url: Optional[str] = None, client=None, prefix: str = "coinconnect"):
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("CHAT_BUS_URL is set but the 'redis' package is not installed")
+            client = redis.from_url(url)
+        self._client = client
+        self._prefix = prefix
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._wanted: Set[str] = set()      # channels this worker's sockets need
+        self._subscribed: Set[str] = set()  # channels Redis has been asked for
+        self._lock = asyncio.Lock()
+        # pubsub.get_message() needs a connection, which the first subscribe opens
+        self._connected = asyncio.Event()
+
+    async def start(self, handler: Handler):
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._listener = asyncio.create_task(self._listen(handler))
+
+    async def subscribe(self, channel: str):
+        self._wanted.add(channel)
+        await self._sync(channel)
+
+    async def unsubscribe(self, channel: str):
+        self._wanted.discard(channel)
+        await self._sync(channel)
+
+    async def _sync(self, channel: str):
+        """Subscribe or unsubscribe so Redis matches whether `channel` is still wanted.
+
+        Serialized, so a room that is left and rejoined while the first call
+        is in flight still ends up subscribed.
+        """
+        async with self._lock:
+            wanted = channel in self._wanted
+            if wanted == (channel in self._subscribed):
+                return
+            if wanted:
+                await self._pubsub.subscribe(f"{self._prefix}:{channel}")
+                self._subscribed.add(channel)
+                self._connected.set()
+            else:
+                await self._pubsub.unsubscribe(f"{self._prefix}:{channel}")
+                self._subscribed.discard(channel)
+
+    async def publish(self, channel: str, event: dict):
+        await self._client.publish(f"{self._prefix}:{channel}", codec.dumps_bytes(event))
+
+    async def _listen(self, handler: Handler):
+        strip = len(self._prefix) + 1
+        await self._connected.wait()
+        while True:
+            try:
+                # redis-py reconnects and resubscribes on the next call after an error
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Chat bus connection lost, reconnecting")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            try:
+                await handler(channel[strip:], codec.loads(message["data"]))
+            except Exception:
+                logger.exception("Failed to deliver bus event on %s", channel)
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+        await self._client.aclose()
+
+
+def create_bus():
+    """RedisBus when CHAT_BUS_URL is set, otherwise the single-worker LocalBus"""
+    url = os.getenv("CHAT_BUS_URL")
+    return RedisBus(url) if url else LocalBus()
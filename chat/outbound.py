@@ -0,0 +1,130 @@
+# chat/outbound.py
+import asyncio
+import os
+from collections import deque
+from typing import Awaitable, Callable, Hashable, Optional, Union
+from fastapi import WebSocket
+from .protocol import JSON_WIRE
+
+# Every socket gets its own bounded queue drained by its own writer task, so a
+# slow client only ever backs up itself. When the queue is full:
+#   drop_oldest - discard the oldest pending frame
+#   coalesce    - replace a pending frame with the same coalesce key (presence,
+#                 unread notifications), otherwise drop the oldest
+#   disconnect  - close the socket with WS_SLOW_CONSUMER_CLOSE_CODE
+OUTBOUND_QUEUE_SIZE = int(os.getenv("WS_OUTBOUND_QUEUE_SIZE", 256))
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+SLOW_CONSUMER_CLOSE_CODE = int(os.getenv("WS_SLOW_CONSUMER_CLOSE_CODE", 1013))
+
+# A socket that cannot take a frame within this many seconds is dropped
+SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 5))
+
+if SLOW_CONSUMER_POLICY not in ("drop_oldest", "coalesce", "disconnect"):
+    raise RuntimeError(f"Unknown WS_SLOW_CONSUMER_POLICY: {SLOW_CONSUMER_POLICY}")
+
+outbound_stats = {
+    "dropped": 0,
+    "coalesced": 0,
+    "slow_disconnects": 0,
+    "send_failures": 0,
+}
+
+
+class Connection:
+    """One accepted WebSocket plus its wire format, outbound queue and writer task.
+
+    Kept to __slots__ and a bare future for wake-ups (rather than an
+    asyncio.Event with its own waiter deque), since there is one per socket.
+    """
+
+    __slots__ = ("websocket", "user_id", "room_id", "wire", "closed", "_on_close", "_queue", "_wakeup", "_writer")
+
+    def __init__(self, websocket: WebSocket, user_id: int, room_id: int,
+                 on_close: Callable[[WebSocket], Awaitable[None]], wire=JSON_WIRE):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.room_id = room_id
+        self.wire = wire  # chat.protocol JsonWire or MsgpackWire
+        self.closed = False
+        self._on_close = on_close
+        self._queue: deque = deque()  # (coalesce_key, frame)
+        self._wakeup: Optional[asyncio.Future] = None  # set while the writer is idle
+        self._writer: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def send_message(self, message: dict, coalesce_key: Optional[Hashable] = None, force: bool = False) -> bool:
+        """Encode a message in this connection's wire format and queue it"""
+        return self.send(self.wire.encode(message), coalesce_key, force)
+
+    def send(self, frame: Union[str, bytes], coalesce_key: Optional[Hashable] = None, force: bool = False) -> bool:
+        """Queue a frame already encoded for self.wire. Returns False if the connection is gone.
+
+        force=True skips the size limit, for replies the client asked for
+        (history pages) that must not be dropped.
+        """
+        if self.closed:
+            return False
+
+        if not force and len(self._queue) >= OUTBOUND_QUEUE_SIZE:
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                outbound_stats["slow_disconnects"] += 1
+                self._abort(SLOW_CONSUMER_CLOSE_CODE)
+                return False
+
+            if SLOW_CONSUMER_POLICY == "coalesce" and coalesce_key is not None:
+                for i, (key, _) in enumerate(self._queue):
+                    if key == coalesce_key:
+                        self._queue[i] = (coalesce_key, frame)
+                        outbound_stats["coalesced"] += 1
+                        return True
+
+            self._queue.popleft()
+            outbound_stats["dropped"] += 1
+
+        self._queue.append((coalesce_key, frame))
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._wakeup = asyncio.get_running_loop().create_future()
+                    await self._wakeup
+                    self._wakeup = None
+                _, frame = self._queue.popleft()
+                if isinstance(frame, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(frame), SEND_TIMEOUT)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(frame), SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            outbound_stats["send_failures"] += 1
+            await self._shutdown(1011)
+
+    def _abort(self, code: int):
+        self.closed = True
+        asyncio.create_task(self._shutdown(code))
+
+    async def _shutdown(self, code: int):
+        self.closed = True
+        await self._on_close(self.websocket)
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def stop(self):
+        """Stop the writer; pending frames are discarded"""
+        self.closed = True
+        self._queue.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
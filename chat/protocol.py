@@ -0,0 +1,124 @@
+# chat/protocol.py
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+from fastapi import WebSocket, WebSocketDisconnect
+import codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# /ws speaks JSON text frames unless the client offers the binary subprotocol
+# in Sec-WebSocket-Protocol. Compression (permessage-deflate) is negotiated
+# by the server for either one; see WS_PER_MESSAGE_DEFLATE in main.py.
+SUBPROTOCOL_MSGPACK = "coinconnect.msgpack.v1"
+SUBPROTOCOL_JSON = "coinconnect.json"
+
+# Set to 0 to stop offering MessagePack even when it is installed
+WS_MSGPACK_ENABLED = os.getenv("WS_MSGPACK_ENABLED", "1") == "1"
+
+# MessagePack frames use these short keys, in both directions. Keys not
+# listed (and all values) are sent as they are.
+FIELD_CODES = {
+    "type": "t",
+    "data": "d",
+    "id": "i",
+    "isMe": "me",
+    "senderId": "s",
+    "senderUsername": "su",
+    "timestamp": "ts",
+    "roomId": "r",
+    "messages": "ms",
+    "names": "n",
+    "final": "f",
+    "info": "in",
+    "hasMoreHistory": "hh",
+    "hasMore": "hm",
+    "beforeId": "b",
+    "limit": "l",
+    "message": "m",
+    "userId": "u",
+    "username": "un",
+    "fromUserId": "fu",
+    "fromUsername": "fn",
+    "unreadCount": "uc",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+class JsonWire:
+    """Text frames, the default"""
+
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        return codec.dumps(message)
+
+    def decode(self, frame: Union[str, bytes]) -> dict:
+        return codec.loads(frame)
+
+
+class MsgpackWire:
+    """Binary frames: MessagePack with FIELD_CODES keys.
+
+    History messages leave out senderUsername; the frame carries one
+    "names" map of senderId -> username instead.
+    """
+
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        messages = message.get("messages")
+        if messages:
+            names: Dict[int, str] = {}
+            slim: List[dict] = []
+            for item in messages:
+                item = dict(item)
+                username = item.pop("senderUsername", None)
+                if username is not None:
+                    names[item["senderId"]] = username
+                slim.append(item)
+            message = {**message, "messages": slim, "names": names}
+        return msgpack.packb(_shorten(message), default=codec.encode_default, use_bin_type=True)
+
+    def decode(self, frame: Union[str, bytes]) -> dict:
+        if isinstance(frame, str):
+            # A client may still send a JSON text frame, e.g. while debugging
+            return codec.loads(frame)
+        message = msgpack.unpackb(frame, raw=False, strict_map_key=False)
+        if not isinstance(message, dict):
+            raise ValueError("Expected a map")
+        return {FIELD_NAMES.get(key, key): value for key, value in message.items()}
+
+
+def _shorten(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {FIELD_CODES.get(key, key): _shorten(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shorten(item) for item in value]
+    return value
+
+
+JSON_WIRE = JsonWire()
+MSGPACK_WIRE = MsgpackWire()
+
+
+def negotiate(websocket: WebSocket) -> Tuple[Union[JsonWire, MsgpackWire], Optional[str]]:
+    """Pick the wire format from the offered subprotocols.
+
+    Returns it with the subprotocol to echo back in the handshake, if any.
+    """
+    offered = websocket.scope.get("subprotocols") or []
+    if SUBPROTOCOL_MSGPACK in offered and msgpack is not None and WS_MSGPACK_ENABLED:
+        return MSGPACK_WIRE, SUBPROTOCOL_MSGPACK
+    return JSON_WIRE, SUBPROTOCOL_JSON if SUBPROTOCOL_JSON in offered else None
+
+
+async def receive_frame(websocket: WebSocket) -> Union[str, bytes]:
+    """Next text or binary frame; raises WebSocketDisconnect like receive_text()"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    text = message.get("text")
+    return text if text is not None else message["bytes"]
@@ -0,0 +1,83 @@
+# chat/receipts.py
+import asyncio
+import logging
+import os
+from typing import Dict, Iterable, Optional, Tuple
+from db import run_db
+from .utils import get_room_last_message_id, save_read_positions
+
+logger = logging.getLogger(__name__)
+
+# Read positions are kept in memory (latest per user and room wins) and
+# written in one batch every READ_RECEIPT_FLUSH_MS, when the socket goes away,
+# or before that user's own unread counts are read.
+READ_RECEIPT_FLUSH_MS = float(os.getenv("READ_RECEIPT_FLUSH_MS", 1000))
+
+
+class ReadReceiptTracker:
+    def __init__(self, flush_ms: float = READ_RECEIPT_FLUSH_MS):
+        self.flush_interval = flush_ms / 1000
+        self._positions: Dict[Tuple[int, int], int] = {}  # (user_id, room_id) -> message id
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"marked": 0, "written": 0, "batches": 0, "failed_batches": 0}
+
+    def mark(self, user_id: int, room_id: int, message_id: int):
+        key = (user_id, room_id)
+        if message_id > self._positions.get(key, 0):
+            self._positions[key] = message_id
+        self.stats["marked"] += 1
+
+    async def mark_room_read(self, user_id: int, room_id: int):
+        """Mark everything currently in the room as read"""
+        # Read from chat_room_summary every time (a primary key lookup): this
+        # worker only hears a room's messages while it holds sockets there
+        last_id = await run_db(get_room_last_message_id, room_id)
+        if last_id:
+            self.mark(user_id, room_id, last_id)
+
+    async def flush_room(self, user_id: int, room_id: int):
+        if (user_id, room_id) in self._positions:
+            await self.flush([(user_id, room_id)])
+
+    async def flush_user(self, user_id: int):
+        keys = [key for key in self._positions if key[0] == user_id]
+        if keys:
+            await self.flush(keys)
+
+    async def flush(self, keys: Optional[Iterable[Tuple[int, int]]] = None):
+        keys = list(self._positions) if keys is None else keys
+        batch = [(user_id, room_id, self._positions.pop((user_id, room_id)))
+                 for user_id, room_id in keys if (user_id, room_id) in self._positions]
+        if not batch:
+            return
+
+        try:
+            await run_db(save_read_positions, batch)
+        except Exception:
+            self.stats["failed_batches"] += 1
+            # Put them back for the next round unless a newer mark arrived
+            for user_id, room_id, message_id in batch:
+                self.mark(user_id, room_id, message_id)
+            raise
+        self.stats["batches"] += 1
+        self.stats["written"] += len(batch)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write read receipts")
+
+
+read_receipts = ReadReceiptTracker()
@@ -74,484 +74,382 @@
 
 # chat/utils.py
 import mysql.connector
-from db import get_db_connection
+from cache import TTLCache
+from db import db_cursor
+from users import search_usernames
 from typing import List, Dict, Optional, Tuple
-from datetime import datetime
+import os
 
+# Chat history is served newest-first in pages keyed on message id
+HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", 200))
 
-def get_user_by_id(user_id: int) -> Optional[Dict]:
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user
+# (smaller user id, larger user id) -> room id. A pair never changes rooms, so
+# the TTL only bounds how long a room deleted by a user cascade lingers.
+_room_ids = TTLCache(
+    maxsize=int(os.getenv("ROOM_CACHE_SIZE", 50000)),
+    ttl=float(os.getenv("ROOM_CACHE_TTL", 3600))
+)
 
 
-def get_user_by_email(email: str) -> Optional[Dict]:
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user
+def get_cached_room_id(user1_id: int, user2_id: int) -> Optional[int]:
+    """Cache-only room lookup, lets async callers skip the DB executor on a hit"""
+    return _room_ids.get((min(user1_id, user2_id), max(user1_id, user2_id)))
 
 
 def get_or_create_chat_room(user1_id: int, user2_id: int) -> int:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Always store user IDs in consistent order (smaller ID first)
-    sorted_ids = sorted([user1_id, user2_id])
-    
-    cursor.execute("""
-        SELECT id FROM chat_rooms 
-        WHERE user1_id = %s AND user2_id = %s
-        LIMIT 1
-    """, (sorted_ids[0], sorted_ids[1]))
-
-    room = cursor.fetchone()
-
-    if room:
-        room_id = room[0]
-    else:
+    sorted_ids = (min(user1_id, user2_id), max(user1_id, user2_id))
+
+    room_id = _room_ids.get(sorted_ids)
+    if room_id is not None:
+        return room_id
+
+    with db_cursor(commit=True) as cursor:
         cursor.execute("""
-            INSERT INTO chat_rooms (user1_id, user2_id)
-            VALUES (%s, %s)
-        """, (sorted_ids[0], sorted_ids[1]))
-        conn.commit()
-        room_id = cursor.lastrowid
-
-    cursor.close()
-    conn.close()
+            SELECT id FROM chat_rooms 
+            WHERE user1_id = %s AND user2_id = %s
+            LIMIT 1
+        """, sorted_ids)
+
+        room = cursor.fetchone()
+
+        if room:
+            room_id = room[0]
+        else:
+            # Two users opening the chat at once both get here; the loser's
+            # insert hits UNIQUE(user1_id, user2_id) and LAST_INSERT_ID(id)
+            # hands back the winner's room instead of an IntegrityError
+            cursor.execute("""
+                INSERT INTO chat_rooms (user1_id, user2_id)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+            """, sorted_ids)
+            room_id = cursor.lastrowid
+
+    _room_ids.set(sorted_ids, room_id)
     return room_id
 
 
-def get_chat_history(room_id: int) -> List[Dict]:
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT cm.id, cm.sender_id, cm.message, cm.created_at, u.username as sender_username
-        FROM chat_messages cm
-        JOIN users u ON cm.sender_id = u.id
-        WHERE cm.room_id = %s
-        ORDER BY cm.created_at ASC
-    """, (room_id,))
-    history = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return history
+def is_room_member(room_id: int, user_id: int) -> bool:
+    with db_cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM chat_rooms
+            WHERE id = %s AND (user1_id = %s OR user2_id = %s)
+        """, (room_id, user_id, user_id))
+        return cursor.fetchone() is not None
+
+
+def get_chat_history(room_id: int, before_id: Optional[int] = None,
+                     limit: int = HISTORY_PAGE_SIZE) -> Tuple[List[Dict], bool]:
+    """Get one page of messages older than before_id (latest page if None).
+
+    Returns (messages oldest first, whether older messages exist). Walks the
+    (room_id, id) index backwards, so the cost is one page regardless of room size.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    before_clause = "AND cm.id < %s" if before_id is not None else ""
+    params = (room_id, before_id, limit + 1) if before_id is not None else (room_id, limit + 1)
+
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"""
+            SELECT cm.id, cm.sender_id, cm.message, cm.created_at, u.username as sender_username
+            FROM chat_messages cm
+            JOIN users u ON cm.sender_id = u.id
+            WHERE cm.room_id = %s {before_clause}
+            ORDER BY cm.id DESC
+            LIMIT %s
+        """, params)
+        rows = cursor.fetchall()
+
+    has_more = len(rows) > limit
+    history = rows[:limit]
+    history.reverse()
+    return history, has_more
+
+
+# Fold a room's newest chat_messages row (plus a count of new rows) into its
+# summary. Assignment order matters: last_message_id has to be compared before
+# it is overwritten, so a message committing out of id order never replaces a
+# newer preview.
+_SUMMARY_UPSERT = """
+    INSERT INTO chat_room_summary
+        (room_id, last_message_id, last_message_preview, last_message_time, message_count)
+    SELECT room_id, id, LEFT(message, 255), created_at, %s
+    FROM chat_messages
+    WHERE id = %s
+    ON DUPLICATE KEY UPDATE
+        last_message_preview = IF(VALUES(last_message_id) > last_message_id, VALUES(last_message_preview), last_message_preview),
+        last_message_time = IF(VALUES(last_message_id) > last_message_id, VALUES(last_message_time), last_message_time),
+        last_message_id = GREATEST(last_message_id, VALUES(last_message_id)),
+        message_count = message_count + VALUES(message_count)
+"""
 
 
 def save_chat_message(room_id: int, sender_id: int, message: str) -> int:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO chat_messages (room_id, sender_id, message)
-        VALUES (%s, %s, %s)
-    """, (room_id, sender_id, message))
-    conn.commit()
-    message_id = cursor.lastrowid
-    cursor.close()
-    conn.close()
-    return message_id
+    return save_chat_messages([(room_id, sender_id, message)])[0]
+
+
+def save_chat_messages(rows: List[Tuple[int, int, str]]) -> List[int]:
+    """Insert (room_id, sender_id, message) rows in one transaction, returning their ids.
+
+    Rows are inserted one by one so every id is exact (a multi-row INSERT
+    only guarantees consecutive ids under some innodb_autoinc_lock_mode
+    settings); the single commit is what saves the fsyncs. Summaries and
+    unread counters are bumped once per room, in room order so concurrent
+    batches lock rows in the same order.
+    """
+    for attempt in range(3):
+        try:
+            message_ids = []
+            newest: Dict[int, Tuple[int, int]] = {}  # room_id -> (last id, count)
+            unread: Dict[Tuple[int, int], int] = {}  # (room_id, sender_id) -> count
+
+            with db_cursor(commit=True) as cursor:
+                for room_id, sender_id, message in rows:
+                    cursor.execute("""
+                        INSERT INTO chat_messages (room_id, sender_id, message)
+                        VALUES (%s, %s, %s)
+                    """, (room_id, sender_id, message))
+                    message_ids.append(cursor.lastrowid)
+                    _, count = newest.get(room_id, (0, 0))
+                    newest[room_id] = (cursor.lastrowid, count + 1)
+                    unread[(room_id, sender_id)] = unread.get((room_id, sender_id), 0) + 1
+
+                for room_id in sorted(newest):
+                    last_id, count = newest[room_id]
+                    cursor.execute(_SUMMARY_UPSERT, (count, last_id))
+
+                # More unread messages for the other participant of each room
+                for (room_id, sender_id) in sorted(unread):
+                    cursor.execute("""
+                        INSERT INTO user_chat_status (user_id, room_id, unread_count)
+                        SELECT IF(user1_id = %s, user2_id, user1_id), id, %s
+                        FROM chat_rooms
+                        WHERE id = %s AND user1_id != user2_id
+                        ON DUPLICATE KEY UPDATE unread_count = unread_count + VALUES(unread_count)
+                    """, (sender_id, unread[(room_id, sender_id)], room_id))
+
+            return message_ids
+        except mysql.connector.errors.DatabaseError as e:
+            # A deadlock rolled the whole batch back, so it is safe to replay
+            if e.errno != 1213 or attempt == 2:
+                raise
+
+
+def backfill_room_summaries(batch_size: int = 1000) -> int:
+    """Rebuild chat_room_summary from chat_messages, a batch of rooms per transaction"""
+    rooms = 0
+    last_room_id = 0
+    while True:
+        with db_cursor(commit=True) as cursor:
+            cursor.execute("""
+                SELECT id FROM chat_rooms
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+            """, (last_room_id, batch_size))
+            room_ids = [row[0] for row in cursor.fetchall()]
+            if not room_ids:
+                return rooms
+
+            cursor.execute("""
+                INSERT INTO chat_room_summary
+                    (room_id, last_message_id, last_message_preview, last_message_time, message_count)
+                SELECT agg.room_id, agg.last_id, LEFT(cm.message, 255), cm.created_at, agg.cnt
+                FROM (
+                    SELECT room_id, MAX(id) AS last_id, COUNT(*) AS cnt
+                    FROM chat_messages
+                    WHERE room_id BETWEEN %s AND %s
+                    GROUP BY room_id
+                ) agg
+                JOIN chat_messages cm ON cm.id = agg.last_id
+                ON DUPLICATE KEY UPDATE
+                    last_message_id = VALUES(last_message_id),
+                    last_message_preview = VALUES(last_message_preview),
+                    last_message_time = VALUES(last_message_time),
+                    message_count = VALUES(message_count)
+            """, (room_ids[0], room_ids[-1]))
+
+        rooms += len(room_ids)
+        last_room_id = room_ids[-1]
 
 
 def search_users_by_username(query: str, current_user_id: int) -> List[Dict]:
     """Search users by username, excluding current user"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT id, username, email
-        FROM users 
-        WHERE username LIKE %s AND id != %s AND disabled = FALSE
-        ORDER BY username
-        LIMIT 20
-    """, (f"%{query}%", current_user_id))
-    users = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return users
+    # One extra row so the current user can be dropped and still leave 20
+    users = search_usernames(query, 21)
+    return [user for user in users if user["id"] != current_user_id][:20]
 
 
 def get_user_chat_list(user_id: int) -> List[Dict]:
     """Get list of conversations for a user with last message and unread count"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute("""
-        SELECT DISTINCT
-            cr.id as room_id,
-            CASE 
-                WHEN cr.user1_id = %s THEN cr.user2_id 
-                ELSE cr.user1_id 
-            END as other_user_id,
-            CASE 
-                WHEN cr.user1_id = %s THEN u2.username 
-                ELSE u1.username 
-            END as other_username,
-            CASE 
-                WHEN cr.user1_id = %s THEN u2.email 
-                ELSE u1.email 
-            END as other_email,
-            (
-                SELECT cm.message 
-                FROM chat_messages cm 
-                WHERE cm.room_id = cr.id 
-                ORDER BY cm.created_at DESC 
-                LIMIT 1
-            ) as last_message,
-            (
-                SELECT cm.created_at 
-                FROM chat_messages cm 
-                WHERE cm.room_id = cr.id 
-                ORDER BY cm.created_at DESC 
-                LIMIT 1
-            ) as last_message_time,
-            (
-                SELECT COUNT(*) 
-                FROM chat_messages cm 
-                WHERE cm.room_id = cr.id 
-                AND cm.sender_id != %s 
-                AND cm.id > COALESCE((
-                    SELECT last_read_message_id 
-                    FROM user_chat_status 
-                    WHERE user_id = %s AND room_id = cr.id
-                ), 0)
-            ) as unread_count
-        FROM chat_rooms cr
-        JOIN users u1 ON cr.user1_id = u1.id
-        JOIN users u2 ON cr.user2_id = u2.id
-        WHERE cr.user1_id = %s OR cr.user2_id = %s
-        HAVING last_message IS NOT NULL
-        ORDER BY last_message_time DESC
-    """, (user_id, user_id, user_id, user_id, user_id, user_id, user_id))
-    
-    conversations = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    
-    # Format timestamps
-    for conv in conversations:
-        if conv['last_message_time']:
-            conv['last_message_time'] = conv['last_message_time'].isoformat()
-    
-    return conversations
-
-
-def mark_messages_as_read(room_id: int, user_id: int):
-    """Mark all messages in a room as read for a user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get the latest message ID in the room
-    cursor.execute("""
-        SELECT MAX(id) as last_message_id
-        FROM chat_messages 
-        WHERE room_id = %s
-    """, (room_id,))
-    
-    result = cursor.fetchone()
-    last_message_id = result[0] if result and result[0] else 0
-    
-    if last_message_id > 0:
-        # Insert or update user chat status
+    with db_cursor(dictionary=True) as cursor:
+        # The two halves of the UNION each use an index on chat_rooms, which a
+        # single `user1_id = ? OR user2_id = ?` filter cannot
         cursor.execute("""
-            INSERT INTO user_chat_status (user_id, room_id, last_read_message_id)
-            VALUES (%s, %s, %s)
-            ON DUPLICATE KEY UPDATE 
-            last_read_message_id = %s
-        """, (user_id, room_id, last_message_id, last_message_id))
-        
-        conn.commit()
-    
-    cursor.close()
-    conn.close()
-
-
-def get_unread_count(room_id: int, user_id: int) -> int:
-    """Get unread message count for a user in a specific room"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT COUNT(*) as unread_count
-        FROM chat_messages cm 
-        WHERE cm.room_id = %s 
-        AND cm.sender_id != %s 
-        AND cm.id > COALESCE((
-            SELECT last_read_message_id 
-            FROM user_chat_status 
-            WHERE user_id = %s AND room_id = %s
-        ), 0)
-    """, (room_id, user_id, user_id, room_id))
-    
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
+            SELECT
+                r.room_id,
+                r.other_user_id,
+                u.username as other_username,
+                u.email as other_email,
+                s.last_message_preview as last_message,
+                s.last_message_time,
+                COALESCE(ucs.unread_count, 0) as unread_count
+            FROM (
+                SELECT id as room_id, user2_id as other_user_id
+                FROM chat_rooms WHERE user1_id = %s
+                UNION ALL
+                SELECT id as room_id, user1_id as other_user_id
+                FROM chat_rooms WHERE user2_id = %s AND user1_id != %s
+            ) r
+            JOIN chat_room_summary s ON s.room_id = r.room_id
+            JOIN users u ON u.id = r.other_user_id
+            LEFT JOIN user_chat_status ucs ON ucs.user_id = %s AND ucs.room_id = r.room_id
+            ORDER BY s.last_message_time DESC, s.last_message_id DESC
+        """, (user_id, user_id, user_id, user_id))
+
+        return cursor.fetchall()
+
+
+def get_room_last_message_id(room_id: int) -> int:
+    with db_cursor() as cursor:
+        cursor.execute(
+            "SELECT last_message_id FROM chat_room_summary WHERE room_id = %s", (room_id,)
+        )
+        result = cursor.fetchone()
     return result[0] if result else 0
 
 
-def get_total_unread_count(user_id: int) -> int:
-    """Get total unread message count across all conversations"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT COUNT(*) as total_unread
-        FROM chat_messages cm
-        JOIN chat_rooms cr ON cm.room_id = cr.id
-        WHERE (cr.user1_id = %s OR cr.user2_id = %s)
-        AND cm.sender_id != %s
-        AND cm.id > COALESCE((
-            SELECT last_read_message_id 
-            FROM user_chat_status 
-            WHERE user_id = %s AND room_id = cm.room_id
-        ), 0)
-    """, (user_id, user_id, user_id, user_id))
-    
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
-    return result[0] if result else 0
-
-    # chat/utils.py
-import mysql.connector
-from db import get_db_connection
-from typing import List, Dict, Optional, Tuple
-from datetime import datetime
-
-
-def get_user_by_id(user_id: int) -> Optional[Dict]:
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user
-
-
-def get_or_create_chat_room(user1_id: int, user2_id: int) -> int:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Always store user IDs in consistent order (smaller ID first)
-    sorted_ids = sorted([user1_id, user2_id])
-    
-    cursor.execute("""
-        SELECT id FROM chat_rooms 
-        WHERE user1_id = %s AND user2_id = %s
-        LIMIT 1
-    """, (sorted_ids[0], sorted_ids[1]))
-
-    room = cursor.fetchone()
-
-    if room:
-        room_id = room[0]
-    else:
-        cursor.execute("""
-            INSERT INTO chat_rooms (user1_id, user2_id)
-            VALUES (%s, %s)
-        """, (sorted_ids[0], sorted_ids[1]))
-        conn.commit()
-        room_id = cursor.lastrowid
-
-    cursor.close()
-    conn.close()
-    return room_id
-
-
-def get_chat_history(room_id: int) -> List[Dict]:
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT cm.id, cm.sender_id, cm.message, cm.created_at, u.username as sender_username
-        FROM chat_messages cm
-        JOIN users u ON cm.sender_id = u.id
-        WHERE cm.room_id = %s
-        ORDER BY cm.created_at ASC
-    """, (room_id,))
-    history = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return history
-
-
-def save_chat_message(room_id: int, sender_id: int, message: str) -> int:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO chat_messages (room_id, sender_id, message)
-        VALUES (%s, %s, %s)
-    """, (room_id, sender_id, message))
-    conn.commit()
-    message_id = cursor.lastrowid
-    cursor.close()
-    conn.close()
-    return message_id
-
-
-def search_users_by_username(query: str, current_user_id: int) -> List[Dict]:
-    """Search users by username, excluding current user"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT id, username, email
-        FROM users 
-        WHERE username LIKE %s AND id != %s AND disabled = FALSE
-        ORDER BY username
-        LIMIT 20
-    """, (f"%{query}%", current_user_id))
-    users = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return users
-
-
-def get_user_chat_list(user_id: int) -> List[Dict]:
-    """Get list of conversations for a user with last message and unread count"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute("""
-        SELECT DISTINCT
-            cr.id as room_id,
-            CASE 
-                WHEN cr.user1_id = %s THEN cr.user2_id 
-                ELSE cr.user1_id 
-            END as other_user_id,
-            CASE 
-                WHEN cr.user1_id = %s THEN u2.username 
-                ELSE u1.username 
-            END as other_username,
-            CASE 
-                WHEN cr.user1_id = %s THEN u2.email 
-                ELSE u1.email 
-            END as other_email,
-            (
-                SELECT cm.message 
-                FROM chat_messages cm 
-                WHERE cm.room_id = cr.id 
-                ORDER BY cm.created_at DESC 
-                LIMIT 1
-            ) as last_message,
-            (
-                SELECT cm.created_at 
-                FROM chat_messages cm 
-                WHERE cm.room_id = cr.id 
-                ORDER BY cm.created_at DESC 
-                LIMIT 1
-            ) as last_message_time,
-            (
-                SELECT COUNT(*) 
-                FROM chat_messages cm 
-                WHERE cm.room_id = cr.id 
-                AND cm.sender_id != %s 
-                AND cm.id > COALESCE((
-                    SELECT last_read_message_id 
-                    FROM user_chat_status 
-                    WHERE user_id = %s AND room_id = cr.id
-                ), 0)
-            ) as unread_count
-        FROM chat_rooms cr
-        JOIN users u1 ON cr.user1_id = u1.id
-        JOIN users u2 ON cr.user2_id = u2.id
-        WHERE cr.user1_id = %s OR cr.user2_id = %s
-        HAVING last_message IS NOT NULL
-        ORDER BY last_message_time DESC
-    """, (user_id, user_id, user_id, user_id, user_id, user_id, user_id))
-    
-    conversations = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    
-    # Format timestamps
-    for conv in conversations:
-        if conv['last_message_time']:
-            conv['last_message_time'] = conv['last_message_time'].isoformat()
-    
-    return conversations
-
-
-def mark_messages_as_read(room_id: int, user_id: int):
-    """Mark all messages in a room as read for a user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get the latest message ID in the room
-    cursor.execute("""
-        SELECT MAX(id) as last_message_id
-        FROM chat_messages 
-        WHERE room_id = %s
-    """, (room_id,))
-    
-    result = cursor.fetchone()
-    last_message_id = result[0] if result and result[0] else 0
-    
-    if last_message_id > 0:
-        # Insert or update user chat status
-        cursor.execute("""
-            INSERT INTO user_chat_status (user_id, room_id, last_read_message_id)
-            VALUES (%s, %s, %s)
-            ON DUPLICATE KEY UPDATE 
-            last_read_message_id = %s
-        """, (user_id, room_id, last_message_id, last_message_id))
-        
-        conn.commit()
-    
-    cursor.close()
-    conn.close()
+def save_read_positions(positions: List[Tuple[int, int, int]]):
+    """Move (user_id, room_id, last_read_message_id) read markers forward in one transaction.
+
+    Each counter is recounted as the other participant's committed messages
+    past the new marker, with the status row locked. Messages do not always
+    commit in id order, so subtracting what lay between the old and new
+    marker would leave a lower id that commits late counted forever. A save
+    bumps the counter under the same row lock, so it has either committed
+    (and is in the recount) or increments after this transaction.
+    """
+    for attempt in range(3):
+        try:
+            with db_cursor(commit=True) as cursor:
+                # A fresh snapshot per statement, so each recount sees every save
+                # that committed before its row lock was taken, not just those
+                # before the batch's first read
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+                for user_id, room_id, message_id in sorted(positions):
+                    # Lock (or create) the status row before counting
+                    cursor.execute("""
+                        INSERT INTO user_chat_status (user_id, room_id)
+                        VALUES (%s, %s)
+                        ON DUPLICATE KEY UPDATE user_id = user_id
+                    """, (user_id, room_id))
+                    cursor.execute("""
+                        SELECT last_read_message_id FROM user_chat_status
+                        WHERE user_id = %s AND room_id = %s
+                        FOR UPDATE
+                    """, (user_id, room_id))
+                    last_read = cursor.fetchone()[0] or 0
+                    if message_id <= last_read:
+                        continue
+
+                    # Walks idx_room_id over the messages still unread, usually few
+                    cursor.execute("""
+                        SELECT COUNT(*) FROM chat_messages
+                        WHERE room_id = %s AND id > %s AND sender_id != %s
+                    """, (room_id, message_id, user_id))
+                    unread_count = cursor.fetchone()[0]
+
+                    cursor.execute("""
+                        UPDATE user_chat_status
+                        SET last_read_message_id = %s, unread_count = %s
+                        WHERE user_id = %s AND room_id = %s
+                    """, (message_id, unread_count, user_id, room_id))
+            return
+        except mysql.connector.errors.DatabaseError as e:
+            # Message batches lock status rows in (room, sender) order, so a
+            # deadlock is possible; the whole batch rolled back and can be replayed
+            if e.errno != 1213 or attempt == 2:
+                raise
 
 
 def get_unread_count(room_id: int, user_id: int) -> int:
     """Get unread message count for a user in a specific room"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT COUNT(*) as unread_count
-        FROM chat_messages cm 
-        WHERE cm.room_id = %s 
-        AND cm.sender_id != %s 
-        AND cm.id > COALESCE((
-            SELECT last_read_message_id 
-            FROM user_chat_status 
+    with db_cursor() as cursor:
+        cursor.execute("""
+            SELECT unread_count
+            FROM user_chat_status
             WHERE user_id = %s AND room_id = %s
-        ), 0)
-    """, (room_id, user_id, user_id, room_id))
-    
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
+        """, (user_id, room_id))
+
+        result = cursor.fetchone()
+
     return result[0] if result else 0
 
 
 def get_total_unread_count(user_id: int) -> int:
     """Get total unread message count across all conversations"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT COUNT(*) as total_unread
-        FROM chat_messages cm
-        JOIN chat_rooms cr ON cm.room_id = cr.id
-        WHERE (cr.user1_id = %s OR cr.user2_id = %s)
-        AND cm.sender_id != %s
-        AND cm.id > COALESCE((
-            SELECT last_read_message_id 
-            FROM user_chat_status 
-            WHERE user_id = %s AND room_id = cm.room_id
-        ), 0)
-    """, (user_id, user_id, user_id, user_id))
-    
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
-    return result[0] if result else 0
\ No newline at end of file
+    with db_cursor() as cursor:
+        cursor.execute("""
+            SELECT COALESCE(SUM(unread_count), 0) as total_unread
+            FROM user_chat_status
+            WHERE user_id = %s
+        """, (user_id,))
+
+        result = cursor.fetchone()
+
+    return int(result[0]) if result else 0
+
+
+def reconcile_unread_counters(batch_size: int = 500) -> int:
+    """Recount user_chat_status.unread_count from chat_messages to repair drift.
+
+    Works through rooms in batches; each batch is one short transaction whose
+    locking reads hold off concurrent sends to those rooms until it commits.
+    Returns the number of counters that changed.
+    """
+    changed = 0
+    last_room_id = 0
+    while True:
+        for attempt in range(3):
+            try:
+                with db_cursor(commit=True) as cursor:
+                    cursor.execute("""
+                        SELECT id FROM chat_rooms
+                        WHERE id > %s
+                        ORDER BY id
+                        LIMIT %s
+                    """, (last_room_id, batch_size))
+                    room_ids = [row[0] for row in cursor.fetchall()]
+                    if not room_ids:
+                        return changed
+
+                    # Both participants get a row, even if they never opened the room
+                    cursor.execute("""
+                        INSERT IGNORE INTO user_chat_status (user_id, room_id)
+                        SELECT user1_id, id FROM chat_rooms WHERE id BETWEEN %s AND %s
+                        UNION ALL
+                        SELECT user2_id, id FROM chat_rooms WHERE id BETWEEN %s AND %s
+                    """, (room_ids[0], room_ids[-1], room_ids[0], room_ids[-1]))
+
+                    cursor.execute("""
+                        UPDATE user_chat_status ucs
+                        SET ucs.unread_count = (
+                            SELECT COUNT(*)
+                            FROM chat_messages cm
+                            WHERE cm.room_id = ucs.room_id
+                            AND cm.sender_id != ucs.user_id
+                            AND cm.id > ucs.last_read_message_id
+                        )
+                        WHERE ucs.room_id BETWEEN %s AND %s
+                    """, (room_ids[0], room_ids[-1]))
+                    batch_changed = cursor.rowcount
+                break
+            except mysql.connector.errors.DatabaseError as e:
+                # Deadlocked against a live send; retry the batch
+                if e.errno != 1213 or attempt == 2:
+                    raise
+
+        changed += batch_changed
+        last_room_id = room_ids[-1]
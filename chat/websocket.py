@@ -75,113 +75,298 @@
 
 
 # chat/websocket.py
-import json
 import sys
+import asyncio
+import logging
 import os
+import time
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, Depends, HTTPException
-from typing import Dict, List, Set
+from typing import Dict, Hashable, List, Optional, Set, Tuple
 
 # Add parent directory to path for imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from .utils import (
-    get_user_by_id, get_or_create_chat_room, get_chat_history, 
-    save_chat_message, search_users_by_username, get_user_chat_list,
-    mark_messages_as_read, get_unread_count, get_total_unread_count
+    get_or_create_chat_room, get_chat_history, 
+    search_users_by_username, get_user_chat_list,
+    get_unread_count, get_total_unread_count,
+    is_room_member, get_cached_room_id, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE
 )
-from auth import get_current_user, get_current_active_user, verify_token
-
+from .bus import create_bus
+from .outbound import Connection, outbound_stats
+from .protocol import JSON_WIRE, negotiate, receive_frame
+from .receipts import read_receipts
+from .writer import message_writer
+from auth import get_current_user, authenticate_token
+from db import run_db
+from users import get_user_by_id
+import metrics
+import timing
+from codec import CodecJSONResponse
+
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
-# Enhanced connection storage
+# Clients that connect with ?protocol=2 get history as batched frames of at
+# most HISTORY_BATCH_SIZE messages; protocol 1 keeps one frame per message.
+HISTORY_BATCH_SIZE = int(os.getenv("CHAT_HISTORY_BATCH_SIZE", 100))
+
+# Enhanced connection storage. Sockets live on one worker; fan-out goes
+# through `bus` so that with a shared broker every worker delivers to its own.
 class ConnectionManager:
-    def __init__(self):
-        # user_id -> Set[WebSocket]
-        self.user_connections: Dict[int, Set[WebSocket]] = {}
-        # room_id -> Set[WebSocket] 
-        self.room_connections: Dict[int, Set[WebSocket]] = {}
-        # websocket -> {user_id, current_room_id}
-        self.connection_info: Dict[WebSocket, Dict] = {}
-
-    async def connect_user(self, websocket: WebSocket, user_id: int, room_id: int):
-        await websocket.accept()
+    def __init__(self, bus=None):
+        # Created in start() unless given, so CHAT_BUS_URL from .env is seen
+        self.bus = bus
+        # user_id -> Set[Connection]
+        self.user_connections: Dict[int, Set[Connection]] = {}
+        # room_id -> Set[Connection]
+        self.room_connections: Dict[int, Set[Connection]] = {}
+        # websocket -> Connection (user_id, room_id, outbound queue)
+        self.connection_info: Dict[WebSocket, Connection] = {}
+        # (user_id, room_id) -> number of that user's sockets open on the room
+        self.presence: Dict[Tuple[int, int], int] = {}
+        # Notifications waiting on their unread count
+        self._pending: Set[asyncio.Task] = set()
+
+    async def connect_user(self, websocket: WebSocket, user_id: int, room_id: int,
+                           wire=JSON_WIRE, subprotocol: Optional[str] = None) -> Connection:
+        await websocket.accept(subprotocol=subprotocol)
+        conn = Connection(websocket, user_id, room_id, on_close=self.disconnect_user, wire=wire)
         
         # Add to user connections
         if user_id not in self.user_connections:
             self.user_connections[user_id] = set()
-        self.user_connections[user_id].add(websocket)
+        self.user_connections[user_id].add(conn)
         
         # Add to room connections
         if room_id not in self.room_connections:
             self.room_connections[room_id] = set()
-        self.room_connections[room_id].add(websocket)
+        self.room_connections[room_id].add(conn)
         
         # Store connection info
-        self.connection_info[websocket] = {
-            "user_id": user_id,
-            "current_room_id": room_id
-        }
+        self.connection_info[websocket] = conn
+        key = (user_id, room_id)
+        self.presence[key] = self.presence.get(key, 0) + 1
+        conn.start()
+
+        # Only now receive the channels this worker has sockets for; no-ops
+        # when they are already subscribed
+        try:
+            await self.bus.subscribe(f"user:{user_id}")
+            await self.bus.subscribe(f"room:{room_id}")
+        except Exception:
+            await self.disconnect_user(websocket)
+            raise
+        return conn
 
     async def disconnect_user(self, websocket: WebSocket):
-        if websocket in self.connection_info:
-            info = self.connection_info[websocket]
-            user_id = info["user_id"]
-            room_id = info["current_room_id"]
-            
-            # Remove from user connections
-            if user_id in self.user_connections:
-                self.user_connections[user_id].discard(websocket)
-                if not self.user_connections[user_id]:
-                    del self.user_connections[user_id]
-            
-            # Remove from room connections
-            if room_id in self.room_connections:
-                self.room_connections[room_id].discard(websocket)
-                if not self.room_connections[room_id]:
-                    del self.room_connections[room_id]
+        conn = self.connection_info.pop(websocket, None)
+        if conn is None:
+            return
+        conn.stop()
+
+        key = (conn.user_id, conn.room_id)
+        if self.presence.get(key, 0) <= 1:
+            self.presence.pop(key, None)
+        else:
+            self.presence[key] -= 1
             
-            # Remove connection info
-            del self.connection_info[websocket]
+        # Remove from user connections
+        if conn.user_id in self.user_connections:
+            self.user_connections[conn.user_id].discard(conn)
+            if not self.user_connections[conn.user_id]:
+                del self.user_connections[conn.user_id]
+                await self._unsubscribe(f"user:{conn.user_id}")
+        
+        # Remove from room connections
+        if conn.room_id in self.room_connections:
+            self.room_connections[conn.room_id].discard(conn)
+            if not self.room_connections[conn.room_id]:
+                del self.room_connections[conn.room_id]
+                await self._unsubscribe(f"room:{conn.room_id}")
+
+    async def _unsubscribe(self, channel: str):
+        # A socket that rejoins meanwhile resubscribes; the bus serializes both
+        try:
+            await self.bus.unsubscribe(channel)
+        except Exception:
+            # Still subscribed; events for it are dropped for lack of sockets
+            logger.exception("Failed to unsubscribe from %s", channel)
+
+    async def start(self):
+        if self.bus is None:
+            self.bus = create_bus()
+        await self.bus.start(self._deliver)
+
+    async def stop(self):
+        await self.bus.stop()
+        for task in list(self._pending):
+            task.cancel()
+
+    # Publishing side: every worker subscribed to the bus delivers the event
+
+    async def send_to_room(self, room_id: int, message: dict, coalesce_key: Optional[Hashable] = None):
+        await self.bus.publish(f"room:{room_id}", {"kind": "frame", "message": message, "coalesceKey": coalesce_key})
+
+    async def send_to_user(self, user_id: int, message: dict, coalesce_key: Optional[Hashable] = None):
+        await self.bus.publish(f"user:{user_id}", {"kind": "frame", "message": message, "coalesceKey": coalesce_key})
+
+    async def send_to_user_outside_room(self, user_id: int, room_id: int, message: dict,
+                                        coalesce_key: Optional[Hashable] = None):
+        """Send to a user unless the worker holding their sockets has them in room_id"""
+        await self.bus.publish(f"user:{user_id}", {
+            "kind": "frame", "message": message, "coalesceKey": coalesce_key, "unlessInRoom": room_id
+        })
 
-    async def send_to_room(self, room_id: int, message: dict):
-        if room_id in self.room_connections:
-            for websocket in self.room_connections[room_id].copy():
-                try:
-                    await websocket.send_text(json.dumps(message))
-                except:
-                    await self.disconnect_user(websocket)
+    async def notify_new_message(self, user_id: int, room_id: int, message: dict):
+        """Notify a user of a message in a room they do not have open.
 
-    async def send_to_user(self, user_id: int, message: dict):
-        if user_id in self.user_connections:
-            for websocket in self.user_connections[user_id].copy():
-                try:
-                    await websocket.send_text(json.dumps(message))
-                except:
-                    await self.disconnect_user(websocket)
+        The worker holding their sockets checks presence first and only then
+        reads the unread count, so a recipient who is in the room elsewhere
+        costs no DB round trip.
+        """
+        await self.bus.publish(f"user:{user_id}", {
+            "kind": "notify", "message": message, "coalesceKey": ("notify", room_id), "unlessInRoom": room_id
+        })
+
+    async def broadcast_chat(self, room_id: int, sender_id: int, message: dict):
+        """Fan a chat message out to a room, encoding each isMe variant once per worker"""
+        await self.bus.publish(f"room:{room_id}", {"kind": "chat", "senderId": sender_id, "message": message})
+
+    # Delivering side: only queues frames on this worker's connections, so it
+    # never waits on a client
+
+    async def _deliver(self, channel: str, event: dict):
+        if event["kind"] == "notify":
+            user_id = int(channel.partition(":")[2])
+            if user_id in self.user_connections and not self.is_user_in_room(user_id, event["unlessInRoom"]):
+                # Needs a DB read, so it runs aside rather than holding up later events
+                task = asyncio.create_task(self._deliver_notification(user_id, channel, event))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+            return
+        started = time.perf_counter()
+        queued = self._queue_frames(channel, event)
+        self._record(event["kind"], started, queued)
+
+    async def _deliver_notification(self, user_id: int, channel: str, event: dict):
+        message = event["message"]
+        try:
+            unread_count = await run_db(get_unread_count, message["roomId"], user_id)
+        except Exception:
+            logger.exception("Failed to read the unread count for a notification to user %s", user_id)
+            return
+        started = time.perf_counter()
+        # _queue_frames checks unlessInRoom again, in case they opened the room meanwhile
+        frame_event = {**event, "kind": "frame", "message": {**message, "unreadCount": unread_count}}
+        queued = self._queue_frames(channel, frame_event)
+        self._record("notify", started, queued)
+
+    def _record(self, kind: str, started: float, queued: int):
+        if queued:
+            metrics.fanout_seconds.labels(kind).observe(time.perf_counter() - started)
+            metrics.fanout_frames.labels(kind).inc(queued)
+
+    def _queue_frames(self, channel: str, event: dict) -> int:
+        """Queue an event on this worker's sockets, returning how many frames were queued"""
+        target, _, target_id = channel.partition(":")
+        conns = (self.room_connections if target == "room" else self.user_connections).get(int(target_id))
+        if not conns:
+            return 0
+
+        queued = 0
+        message = event["message"]
+        if event["kind"] == "chat":
+            # One encoding per (wire format, isMe) variant, not per socket
+            frames = {}
+            for conn in list(conns):
+                is_me = conn.user_id == event["senderId"]
+                frame = frames.get((conn.wire, is_me))
+                if frame is None:
+                    frame = frames[(conn.wire, is_me)] = conn.wire.encode({**message, "isMe": is_me})
+                if conn.send(frame):
+                    queued += 1
+                    if not is_me:
+                        # Seen live, so it is read; written with the next batch
+                        read_receipts.mark(conn.user_id, conn.room_id, message["id"])
+            return queued
+
+        room_id = event.get("unlessInRoom")
+        if room_id is not None and self.is_user_in_room(int(target_id), room_id):
+            return 0
+
+        key = event.get("coalesceKey")
+        coalesce_key = tuple(key) if isinstance(key, list) else key
+        frames = {}
+        for conn in list(conns):
+            frame = frames.get(conn.wire)
+            if frame is None:
+                frame = frames[conn.wire] = conn.wire.encode(message)
+            queued += conn.send(frame, coalesce_key)
+        return queued
 
     def is_user_in_room(self, user_id: int, room_id: int) -> bool:
-        if user_id not in self.user_connections:
-            return False
-        
-        for websocket in self.user_connections[user_id]:
-            if websocket in self.connection_info:
-                if self.connection_info[websocket]["current_room_id"] == room_id:
-                    return True
-        return False
+        return (user_id, room_id) in self.presence
+
+    def stats(self) -> dict:
+        depths = [conn.depth for conn in self.connection_info.values()]
+        return {
+            "connections": len(depths),
+            "users": len(self.user_connections),
+            "rooms": len(self.room_connections),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "max_connections_per_user": max(map(len, self.user_connections.values()), default=0),
+            "max_connections_per_room": max(map(len, self.room_connections.values()), default=0),
+            **outbound_stats,
+        }
 
 manager = ConnectionManager()
 
+def history_item(msg: dict, user_id: int) -> dict:
+    return {
+        "type": "history",
+        "isMe": msg["sender_id"] == user_id,
+        "data": msg["message"],
+        "senderId": msg["sender_id"],
+        "senderUsername": msg.get("sender_username", "Unknown"),
+        "timestamp": msg["created_at"],
+        "id": msg["id"]
+    }
+
+def send_history(conn: Connection, messages: List[dict], user_id: int, protocol: int):
+    items = [history_item(msg, user_id) for msg in messages]
+    if protocol < 2:
+        for item in items:
+            conn.send_message(item, force=True)
+        return
+
+    # Always send at least one (possibly empty) batch so clients see "final"
+    for start in range(0, max(len(items), 1), HISTORY_BATCH_SIZE):
+        chunk = items[start:start + HISTORY_BATCH_SIZE]
+        conn.send_message({
+            "type": "history_batch",
+            "messages": chunk,
+            "final": start + HISTORY_BATCH_SIZE >= len(items)
+        }, force=True)
+
 @router.websocket("/ws")
 async def chat_socket(
     websocket: WebSocket, 
     userId: int = Query(...), 
     recipientId: int = Query(...),
-    token: str = Query(...)
+    token: str = Query(...),
+    protocol: int = Query(1)
 ):
     # print(f"WebSocket connection attempt: userId={userId}, recipientId={recipientId}, token={'***' if token else 'None'}")
+
+    # Time the setup stages below; the receive loop is not timed
+    setup_started = time.perf_counter()
+    timing_token = timing.start()
     
     # Verify token and authenticate user
-    authenticated_user = verify_token(token)
+    with timing.span("auth"):
+        authenticated_user = await authenticate_token(token)
     if not authenticated_user:
         # print("Token verification failed")
         await websocket.close(code=1008, reason="Invalid token")
@@ -195,8 +380,8 @@ async def chat_socket(
     # print(f"WebSocket authentication successful for user: {authenticated_user['email']}")
     
     # Validate users
-    sender = get_user_by_id(userId)
-    recipient = get_user_by_id(recipientId)
+    sender = await run_db(get_user_by_id, userId)
+    recipient = await run_db(get_user_by_id, recipientId)
 
     if not sender or not recipient:
         # print(f"Invalid users: sender={bool(sender)}, recipient={bool(recipient)}")
@@ -204,53 +389,88 @@ async def chat_socket(
         return
 
     # Get or create room
-    room_id = get_or_create_chat_room(userId, recipientId)
+    room_id = get_cached_room_id(userId, recipientId)
+    if room_id is None:
+        room_id = await run_db(get_or_create_chat_room, userId, recipientId)
     # print(f"Chat room ID: {room_id}")
 
-    # Connect user to manager
-    await manager.connect_user(websocket, userId, room_id)
-
-    # Mark messages as read when user opens chat
-    mark_messages_as_read(room_id, userId)
-
-    # Send previous chat history
-    chat_history = get_chat_history(room_id)
-    for msg in chat_history:
-        await websocket.send_text(json.dumps({
-            "type": "history",
-            "isMe": msg["sender_id"] == userId,
-            "data": msg["message"],
-            "senderId": msg["sender_id"],
-            "senderUsername": msg.get("sender_username", "Unknown"),
-            "timestamp": msg["created_at"].isoformat(),
-            "id": msg["id"]
-        }))
-
-    # Send connection confirmation
-    await websocket.send_text(json.dumps({
-        "type": "info",
-        "info": "Connected to chat room",
-        "roomId": room_id
-    }))
-
-    # Notify recipient about online status
-    await manager.send_to_user(recipientId, {
-        "type": "user_online",
-        "userId": userId,
-        "username": sender["username"]
-    })
+    # JSON text frames unless the client offered the MessagePack subprotocol;
+    # binary clients always get batched history
+    wire, subprotocol = negotiate(websocket)
+    if wire.binary:
+        protocol = max(protocol, 2)
+
+    # Connect user to manager; from here on every frame goes through conn
+    with timing.span("accept"):
+        conn = await manager.connect_user(websocket, userId, room_id, wire, subprotocol)
 
+    # Everything after connect_user is inside the try, so the connection is
+    # always unregistered even if setup fails
     try:
+        # Send the latest page of chat history; older pages are requested with
+        # {"type": "load_history", "beforeId": <oldest id seen>}
+        chat_history, has_more = await run_db(get_chat_history, room_id)
+        with timing.span("encode"):
+            send_history(conn, chat_history, userId, protocol)
+
+        # Opening the chat reads everything up to the newest message just sent
+        if chat_history:
+            read_receipts.mark(userId, room_id, chat_history[-1]["id"])
+
+        # Send connection confirmation
+        conn.send_message({
+            "type": "info",
+            "info": "Connected to chat room",
+            "roomId": room_id,
+            "hasMoreHistory": has_more
+        }, force=True)
+
+        # Notify recipient about online status
+        await manager.send_to_user(recipientId, {
+            "type": "user_online",
+            "userId": userId,
+            "username": sender["username"]
+        }, coalesce_key=("presence", userId))
+
+        spans = timing.finish(timing_token)
+        if spans is not None:
+            timing.log("ws_connect", spans, time.perf_counter() - setup_started,
+                       room_id=room_id, protocol=protocol, binary=wire.binary)
+
         while True:
-            data = await websocket.receive_text()
-            parsed = json.loads(data)
+            parsed = conn.wire.decode(await receive_frame(websocket))
+
+            if parsed.get("type") == "load_history":
+                try:
+                    before_id = parsed.get("beforeId")
+                    before_id = None if before_id is None else int(before_id)
+                    limit = int(parsed.get("limit") or HISTORY_PAGE_SIZE)
+                except (TypeError, ValueError):
+                    # A bad request from the client, not a reason to drop the socket
+                    conn.send_message({
+                        "type": "error",
+                        "error": "beforeId and limit must be integers",
+                        "request": "load_history"
+                    }, force=True)
+                    continue
+                limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+                page, has_more = await run_db(get_chat_history, room_id, before_id, limit)
+                conn.send_message({
+                    "type": "history_page",
+                    "beforeId": before_id,
+                    "messages": [history_item(msg, userId) for msg in page],
+                    "hasMore": has_more
+                }, force=True)
+                continue
 
             message_text = parsed.get("message")
             if not message_text:
                 continue
 
-            # Save message to DB
-            message_id = save_chat_message(room_id, userId, message_text)
+            received_at = time.perf_counter()
+
+            # Save message to DB; resolves once its group commit is done
+            message_id = await message_writer.save(room_id, userId, message_text)
 
             # Prepare message data
             message_data = {
@@ -264,27 +484,27 @@ async def chat_socket(
             }
 
             # Send to all users in the room
-            for websocket_conn in manager.room_connections.get(room_id, set()).copy():
-                conn_info = manager.connection_info.get(websocket_conn)
-                if conn_info:
-                    msg_copy = message_data.copy()
-                    msg_copy["isMe"] = conn_info["user_id"] == userId
-                    await websocket_conn.send_text(json.dumps(msg_copy))
-
-            # Send notification to recipient if they're not in this room
+            await manager.broadcast_chat(room_id, userId, message_data)
+            metrics.chat_messages.inc()
+            metrics.chat_send_seconds.observe(time.perf_counter() - received_at)
+
+            # Send notification to recipient if they're not in this room.
+            # Only this worker's sockets are checked here; the worker holding
+            # the recipient re-checks and adds the unread count.
             if not manager.is_user_in_room(recipientId, room_id):
-                unread_count = get_unread_count(room_id, recipientId)
-                await manager.send_to_user(recipientId, {
+                await manager.notify_new_message(recipientId, room_id, {
                     "type": "new_message_notification",
                     "fromUserId": userId,
                     "fromUsername": sender["username"],
                     "message": message_text,
-                    "roomId": room_id,
-                    "unreadCount": unread_count
+                    "roomId": room_id
                 })
 
     except WebSocketDisconnect:
         # print(f"WebSocket disconnected for user {userId}")
+        pass
+    finally:
+        # Also reached when the writer closed us as a slow consumer
         await manager.disconnect_user(websocket)
         
         # Notify recipient about offline status
@@ -292,7 +512,10 @@ async def chat_socket(
             "type": "user_offline",
             "userId": userId,
             "username": sender["username"]
-        })
+        }, coalesce_key=("presence", userId))
+
+        # Write this chat's read position now rather than on the next tick
+        await read_receipts.flush_room(userId, room_id)
 
 # REST API Endpoints
 @router.get("/api/chat/search-users")
@@ -301,25 +524,47 @@ async def search_users(q: str, current_user: dict = Depends(get_current_user)):
     # print(f"Search users called by user: {current_user['email']} for query: '{q}'")
     
     if len(q.strip()) < 2:
-        return {"users": []}
+        return CodecJSONResponse({"users": []})
     
     try:
-        users = search_users_by_username(q, current_user["id"])
+        users = await run_db(search_users_by_username, q, current_user["id"])
         # print(f"Found {len(users)} users")
-        return {"users": users}
+        return CodecJSONResponse({"users": users})
     except Exception as e:
         # print(f"Error in search_users: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@router.get("/api/chat/history/{room_id}")
+async def get_room_history(
+    room_id: int,
+    before_id: Optional[int] = None,
+    limit: int = HISTORY_PAGE_SIZE,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get a page of messages older than before_id, oldest first"""
+    if not await run_db(is_room_member, room_id, current_user["id"]):
+        raise HTTPException(status_code=403, detail="Not a member of this chat")
+
+    try:
+        page, has_more = await run_db(get_chat_history, room_id, before_id, limit)
+        return CodecJSONResponse({
+            "messages": [history_item(msg, current_user["id"]) for msg in page],
+            "hasMore": has_more
+        })
+    except Exception:
+        logger.exception("Failed to load history for room %s", room_id)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @router.get("/api/chat/conversations")
 async def get_conversations(current_user: dict = Depends(get_current_user)):
     """Get user's chat list with unread counts"""
     # print(f"Get conversations called by user: {current_user['email']}")
     
     try:
-        chat_list = get_user_chat_list(current_user["id"])
+        await read_receipts.flush_user(current_user["id"])
+        chat_list = await run_db(get_user_chat_list, current_user["id"])
         # print(f"Found {len(chat_list)} conversations")
-        return {"conversations": chat_list}
+        return CodecJSONResponse({"conversations": chat_list})
     except Exception as e:
         # print(f"Error in get_conversations: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -330,8 +575,8 @@ async def mark_chat_read(room_id: int, current_user: dict = Depends(get_current_
     # print(f"Mark read called by user: {current_user['email']} for room: {room_id}")
     
     try:
-        mark_messages_as_read(room_id, current_user["id"])
-        return {"success": True}
+        await read_receipts.mark_room_read(current_user["id"], room_id)
+        return CodecJSONResponse({"success": True})
     except Exception as e:
         # print(f"Error in mark_chat_read: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -342,8 +587,9 @@ async def get_total_unread(current_user: dict = Depends(get_current_user)):
     # print(f"Get unread count called by user: {current_user['email']}")
     
     try:
-        total_unread = get_total_unread_count(current_user["id"])
-        return {"unreadCount": total_unread}
+        await read_receipts.flush_user(current_user["id"])
+        total_unread = await run_db(get_total_unread_count, current_user["id"])
+        return CodecJSONResponse({"unreadCount": total_unread})
     except Exception as e:
         # print(f"Error in get_total_unread: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
\ No newline at end of file
@@ -0,0 +1,103 @@
+# chat/writer.py
+import asyncio
+import os
+from typing import List, Optional, Tuple
+from db import run_db
+from .utils import save_chat_message, save_chat_messages
+
+# CHAT_WRITE_MODE=batch groups messages from every socket into one
+# transaction, flushed after CHAT_WRITE_FLUSH_MS or at CHAT_WRITE_BATCH_SIZE
+# rows. A sender only gets its message id (and the room its frame) after the
+# batch has committed, so nothing unflushed is ever acknowledged; what a crash
+# can lose is at most one window of unacknowledged messages.
+# CHAT_WRITE_MODE=direct commits every message on its own.
+CHAT_WRITE_MODE = os.getenv("CHAT_WRITE_MODE", "batch")
+CHAT_WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", 100))
+CHAT_WRITE_FLUSH_MS = float(os.getenv("CHAT_WRITE_FLUSH_MS", 5))
+
+if CHAT_WRITE_MODE not in ("batch", "direct"):
+    raise RuntimeError(f"Unknown CHAT_WRITE_MODE: {CHAT_WRITE_MODE}")
+
+
+class MessageWriter:
+    """Group-commits chat messages saved from any socket"""
+
+    def __init__(self, batch_size: int = CHAT_WRITE_BATCH_SIZE, flush_ms: float = CHAT_WRITE_FLUSH_MS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self._pending: List[Tuple[int, int, str, asyncio.Future]] = []
+        self._has_work = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Future] = None
+        self.stats = {"batches": 0, "messages": 0, "failed_batches": 0}
+
+    def start(self):
+        if CHAT_WRITE_MODE == "batch":
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop after committing whatever is still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._inflight is not None:
+            await self._inflight
+        while self._pending:
+            await self._flush(self._take())
+
+    async def save(self, room_id: int, sender_id: int, message: str) -> int:
+        """Resolve with the message id once the message is committed"""
+        if self._task is None:
+            return await run_db(save_chat_message, room_id, sender_id, message)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((room_id, sender_id, message, future))
+        self._has_work.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        return await future
+
+    def _take(self) -> List[Tuple[int, int, str, asyncio.Future]]:
+        batch = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+        if not self._pending:
+            self._has_work.clear()
+        if len(self._pending) < self.batch_size:
+            self._full.clear()
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._has_work.wait()
+            # Give other sockets one window to join this batch
+            if len(self._pending) < self.batch_size and self.flush_interval > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            # Shielded so stop() never abandons a batch halfway through a commit
+            self._inflight = asyncio.ensure_future(self._flush(self._take()))
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+
+    async def _flush(self, batch: List[Tuple[int, int, str, asyncio.Future]]):
+        if not batch:
+            return
+        try:
+            message_ids = await run_db(save_chat_messages, [row[:3] for row in batch])
+        except Exception as e:
+            self.stats["failed_batches"] += 1
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.stats["batches"] += 1
+        self.stats["messages"] += len(batch)
+        for (*_, future), message_id in zip(batch, message_ids):
+            if not future.done():
+                future.set_result(message_id)
+
+
+message_writer = MessageWriter()
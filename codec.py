@@ -0,0 +1,71 @@
+# codec.py
+import datetime
+import decimal
+import json
+import os
+import uuid
+from typing import Any
+from fastapi.responses import JSONResponse
+import timing
+
+# One JSON codec for REST responses, WebSocket frames and bus events.
+# JSON_CODEC=auto uses orjson when it is installed, otherwise the stdlib;
+# orjson or json force one (orjson fails loudly if it is missing).
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")
+
+if JSON_CODEC not in ("auto", "orjson", "json"):
+    raise RuntimeError(f"Unknown JSON_CODEC: {JSON_CODEC}")
+
+
+def encode_default(obj: Any):
+    """Types the database hands back that JSON (and MessagePack) have no literal for"""
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+orjson = None
+if JSON_CODEC != "json":
+    try:
+        import orjson
+    except ImportError:
+        if JSON_CODEC == "orjson":
+            raise RuntimeError("JSON_CODEC=orjson but the 'orjson' package is not installed")
+
+if orjson is not None:
+    CODEC_NAME = "orjson"
+
+    def dumps_bytes(obj: Any) -> bytes:
+        # orjson writes datetimes itself, in the same form as isoformat()
+        return orjson.dumps(obj, default=encode_default)
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj, default=encode_default).decode()
+
+    loads = orjson.loads
+else:
+    CODEC_NAME = "json"
+    _encoder = json.JSONEncoder(default=encode_default, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(obj: Any) -> str:
+        return _encoder.encode(obj)
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return _encoder.encode(obj).encode()
+
+    loads = json.loads
+
+
+class CodecJSONResponse(JSONResponse):
+    """JSONResponse rendered with the codec. Routes that return one directly
+    also skip FastAPI's jsonable_encoder pass."""
+
+    def render(self, content: Any) -> bytes:
+        with timing.span("encode"):
+            return dumps_bytes(content)
@@ -17,11 +17,23 @@
 
 # db.py
 import mysql.connector
-import uuid
-from dotenv import load_dotenv
+import asyncio
+import contextlib
+import logging
+import re
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import os
+import metrics
+import timing
+from cache import TTLCache
 
 def get_db_connection():
+    """Open a brand new MySQL connection. Application code should use db_cursor()."""
     return mysql.connector.connect(
         host=os.getenv("DB_HOST"),
         user=os.getenv("DB_USER"),
@@ -31,68 +43,376 @@ def get_db_connection():
         # charset='utf8mb4',
     )
 
-def init_db_schema():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # USERS table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            username VARCHAR(50) NOT NULL UNIQUE,
-            email VARCHAR(100) NOT NULL UNIQUE,
-            hashed_password VARCHAR(255) NOT NULL,
-            disabled BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    # CHAT_ROOMS table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chat_rooms (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            user1_id INT NOT NULL,
-            user2_id INT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user1_id, user2_id),
-            FOREIGN KEY (user1_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (user2_id) REFERENCES users(id) ON DELETE CASCADE
-        );
-    """)
-
-    # CHAT_MESSAGES table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chat_messages (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            room_id INT NOT NULL,
-            sender_id INT NOT NULL,
-            message TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (room_id) REFERENCES chat_rooms(id) ON DELETE CASCADE,
-            FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE,
-            INDEX idx_room_created (room_id, created_at),
-            INDEX idx_sender_room (sender_id, room_id)
-        );
-    """)
-
-    # USER_CHAT_STATUS table for tracking read messages
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_chat_status (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            user_id INT NOT NULL,
-            room_id INT NOT NULL,
-            last_read_message_id INT DEFAULT 0,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            UNIQUE(user_id, room_id),
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (room_id) REFERENCES chat_rooms(id) ON DELETE CASCADE,
-            INDEX idx_user_room (user_id, room_id)
-        );
-    """)
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection could be checked out before the pool timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe MySQL connection pool.
+
+    Keeps up to `size` idle connections around and allows `max_overflow` extra
+    connections under load; overflow connections are closed when returned.
+    Connections older than `recycle` seconds are replaced on checkout and, with
+    `pre_ping`, idle connections are pinged before being handed out.
+    """
+
+    def __init__(self, size=5, max_overflow=10, timeout=30.0, recycle=3600, pre_ping=True, connect=get_db_connection):
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self._connect = connect
+        self._cond = threading.Condition()
+        self._idle = deque()  # LIFO so the warmest connections get reused
+        self._born: dict = {}  # id(conn) -> creation time
+        self._open = 0
+        self._checked_out = 0
+        self._counters = {
+            "checkouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "invalidated": 0,
+            "timeouts": 0,
+            "wait_seconds": 0.0,
+        }
+
+    def _create(self):
+        conn = self._connect()
+        self._born[id(conn)] = time.monotonic()
+        self._counters["created"] += 1
+        return conn
+
+    def _close(self, conn):
+        self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _revive(self, conn):
+        """Return a usable connection, replacing `conn` if it is stale or dead."""
+        age = time.monotonic() - self._born.get(id(conn), 0)
+        if self.recycle and age > self.recycle:
+            self._counters["recycled"] += 1
+        elif not self.pre_ping:
+            return conn
+        else:
+            try:
+                if conn.is_connected():
+                    return conn
+            except Exception:
+                pass
+            self._counters["invalidated"] += 1
+        self._close(conn)
+        return self._create()
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._open < self.size + self.max_overflow:
+                    self._open += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeoutError(
+                        f"No database connection available within {self.timeout}s "
+                        f"(size={self.size}, overflow={self.max_overflow})"
+                    )
+                self._cond.wait(remaining)
+            self._checked_out += 1
+            self._counters["checkouts"] += 1
+            self._counters["wait_seconds"] += time.monotonic() - started
+
+        try:
+            return self._create() if conn is None else self._revive(conn)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        # End whatever transaction the caller left open so the next user does
+        # not inherit its locks or its REPEATABLE READ snapshot.
+        try:
+            conn.rollback()
+            healthy = True
+        except Exception:
+            healthy = False
+
+        with self._cond:
+            self._checked_out -= 1
+            keep = healthy and len(self._idle) < self.size
+            if keep:
+                self._idle.append(conn)
+            else:
+                self._open -= 1
+            self._cond.notify()
+        if not keep:
+            self._close(conn)
+
+    def dispose(self):
+        """Close every idle connection. Checked out connections close on release."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self.size,
+                "max_overflow": self.max_overflow,
+                "open": self._open,
+                "idle": len(self._idle),
+                "checked_out": self._checked_out,
+                "overflow": max(self._open - self.size, 0),
+                **self._counters,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """Return the process-wide pool, creating it from DB_POOL_* settings on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    size=int(os.getenv("DB_POOL_SIZE", 5)),
+                    max_overflow=int(os.getenv("DB_POOL_MAX_OVERFLOW", 10)),
+                    timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+                    recycle=int(os.getenv("DB_POOL_RECYCLE", 3600)),
+                    pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+                )
+    return _pool
+
+@contextmanager
+def db_connection():
+    """Check a connection out of the pool for the duration of the block."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+# Slow-query log. Statements slower than DB_SLOW_QUERY_MS (negative turns it
+# off) are logged to the "db.slow_query" logger with their normalized SQL, the
+# shape of their parameters (never the values) and the calling function. The
+# first time a fingerprint is slow, its EXPLAIN is captured on a separate
+# pooled connection by a background thread. At most DB_SLOW_QUERY_LOG_PER_MIN
+# lines are written per minute; the rest are counted and reported with the
+# next line that gets through.
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 250))
+SLOW_QUERY_LOG_PER_MIN = int(os.getenv("DB_SLOW_QUERY_LOG_PER_MIN", 30))
+SLOW_QUERY_EXPLAIN = os.getenv("DB_SLOW_QUERY_EXPLAIN", "true").lower() in ("1", "true", "yes")
+
+slow_query_logger = logging.getLogger("db.slow_query")
+
+_SQL_LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b|%s|%\(\w+\)s")
+_SQL_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+_explained = TTLCache(maxsize=1000, ttl=3600)  # fingerprints with a captured plan
+_explain_executor = None
+_log_lock = threading.Lock()
+_log_tokens = float(SLOW_QUERY_LOG_PER_MIN)
+_log_refilled = time.monotonic()
+_log_suppressed = 0
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and replace literals and placeholders with ?"""
+    sql = _SQL_LITERALS.sub("?", " ".join(sql.split()))
+    return _SQL_LISTS.sub("(...)", sql)
+
+def _params_shape(params) -> str:
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in params.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in params) + ")"
+
+def _caller() -> str:
+    """The first frame outside db.py and contextlib, i.e. the helper that ran the query"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename in (__file__, contextlib.__file__):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}:{frame.f_lineno}"
+
+def _take_log_token() -> int:
+    """-1 if the line must be dropped, else how many were dropped before it"""
+    global _log_tokens, _log_refilled, _log_suppressed
+    with _log_lock:
+        now = time.monotonic()
+        _log_tokens = min(SLOW_QUERY_LOG_PER_MIN, _log_tokens + (now - _log_refilled) * SLOW_QUERY_LOG_PER_MIN / 60)
+        _log_refilled = now
+        if _log_tokens < 1:
+            _log_suppressed += 1
+            return -1
+        _log_tokens -= 1
+        suppressed, _log_suppressed = _log_suppressed, 0
+        return suppressed
+
+def _explain(fingerprint: str, sql: str, params):
+    try:
+        with db_connection() as conn:
+            # A plain cursor, so the EXPLAIN itself is never timed or logged
+            cursor = conn.cursor(dictionary=True, buffered=True)
+            try:
+                cursor.execute("EXPLAIN " + sql, params)
+                plan = cursor.fetchall()
+            finally:
+                cursor.close()
+    except Exception as e:
+        _explained.pop(fingerprint)
+        slow_query_logger.debug("EXPLAIN failed for %s: %s", fingerprint, e)
+        return
+    slow_query_logger.warning(
+        "slow query plan: %s | %s", fingerprint,
+        "; ".join(
+            f"{row.get('table')} type={row.get('type')} key={row.get('key')} rows={row.get('rows')} "
+            f"filtered={row.get('filtered')} extra={row.get('Extra')}"
+            for row in plan
+        ),
+        extra={"fingerprint": fingerprint, "plan": plan},
+    )
+
+def _record_slow_query(sql: str, params, seconds: float, rows: int = 1):
+    global _explain_executor
+    metrics.db_slow_queries.inc()
+    fingerprint = normalize_sql(sql)
+    suppressed = _take_log_token()
+    if suppressed >= 0:
+        caller = _caller()
+        shape = _params_shape(params) if rows == 1 else f"{rows} x {_params_shape(params)}"
+        slow_query_logger.warning(
+            "slow query %.1fms in %s: %s params=%s%s",
+            seconds * 1000, caller, fingerprint, shape,
+            f" ({suppressed} more suppressed)" if suppressed else "",
+            extra={"duration_ms": seconds * 1000, "caller": caller, "fingerprint": fingerprint,
+                   "params_shape": shape, "suppressed": suppressed},
+        )
+
+    if (SLOW_QUERY_EXPLAIN and rows == 1 and _explained.get(fingerprint) is None
+            and sql.lstrip().split(None, 1)[0].upper() in _EXPLAINABLE):
+        _explained.set(fingerprint, True)
+        with _log_lock:
+            if _explain_executor is None:
+                _explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+        _explain_executor.submit(_explain, fingerprint, sql, params)
+
+class TimedCursor:
+    """Cursor wrapper that sends statements over SLOW_QUERY_MS to the slow-query log"""
+
+    __slots__ = ("_cursor",)
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            if seconds * 1000 >= SLOW_QUERY_MS:
+                _record_slow_query(operation, params, seconds)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, seq_params, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            if seconds * 1000 >= SLOW_QUERY_MS:
+                _record_slow_query(operation, seq_params[0] if seq_params else None, seconds, len(seq_params))
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+@contextmanager
+def db_cursor(dictionary: bool = False, commit: bool = False):
+    """Yield a buffered cursor on a pooled connection.
+
+    With commit=True the transaction is committed when the block exits cleanly;
+    otherwise (or on error) it is rolled back when the connection is returned.
+    Statements go through the slow-query log unless DB_SLOW_QUERY_MS < 0.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=dictionary, buffered=True)
+        try:
+            yield TimedCursor(cursor) if SLOW_QUERY_MS >= 0 else cursor
+            if commit:
+                conn.commit()
+        finally:
+            cursor.close()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Thread pool that runs blocking DB helpers off the event loop.
+
+    Sized to the connection pool (DB_EXECUTOR_WORKERS overrides) so a worker
+    thread never sits waiting for a connection checkout.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                pool = get_pool()
+                workers = int(os.getenv("DB_EXECUTOR_WORKERS", pool.size + pool.max_overflow))
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+    return _executor
+
+def _timed_call(queued_at: float, func, args, kwargs):
+    started = time.perf_counter()
+    metrics.db_executor_wait_seconds.observe(started - queued_at)
+    name = f"{func.__module__}.{func.__qualname__}"
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        metrics.db_call_errors.labels(name).inc()
+        raise
+    finally:
+        metrics.db_call_seconds.labels(name).observe(time.perf_counter() - started)
+
+async def run_db(func, *args, **kwargs):
+    """Await a blocking DB function (e.g. a chat.utils helper) on the DB executor."""
+    loop = asyncio.get_running_loop()
+    with timing.span(f"db.{func.__name__}"):
+        return await loop.run_in_executor(
+            get_db_executor(), _timed_call, time.perf_counter(), func, args, kwargs
+        )
+
+def shutdown_db():
+    """Stop the DB executor and close pooled connections."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    get_pool().dispose()
 
 
 
@@ -0,0 +1,104 @@
+# hashing.py
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+import metrics
+import timing
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt is pure CPU, so one worker process per core; requests beyond
+# HASH_MAX_PENDING in flight are turned away with a 503 instead of queueing.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", HASH_WORKERS * 4))
+
+_executor = None
+_pending = 0
+_rejected = 0
+_latency = {
+    "hash": {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+    "verify": {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+}
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _noop():
+    return None
+
+
+def get_hash_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+    return _executor
+
+
+async def start_hasher():
+    """Fork the worker processes up front, before the app starts other threads."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(get_hash_executor(), _noop)
+
+
+def stop_hasher():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def _record(op: str, seconds: float):
+    metrics.hash_seconds.labels(op).observe(seconds)
+    stats = _latency[op]
+    stats["count"] += 1
+    stats["total_seconds"] += seconds
+    stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+
+async def _submit(op: str, func, *args):
+    global _pending, _rejected
+    if _pending >= HASH_MAX_PENDING:
+        _rejected += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please retry",
+            headers={"Retry-After": "1"},
+        )
+
+    _pending += 1
+    started = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        with timing.span(f"bcrypt.{op}"):
+            return await loop.run_in_executor(get_hash_executor(), func, *args)
+    finally:
+        _pending -= 1
+        _record(op, time.perf_counter() - started)
+
+
+async def get_password_hash(password: str) -> str:
+    return await _submit("hash", _hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _submit("verify", _verify, plain_password, hashed_password)
+
+
+def hash_stats() -> dict:
+    """Latency (queueing included) per operation plus current pool pressure."""
+    return {
+        "workers": HASH_WORKERS,
+        "max_pending": HASH_MAX_PENDING,
+        "pending": _pending,
+        "rejected": _rejected,
+        "latency": {op: dict(stats) for op, stats in _latency.items()},
+    }
@@ -173,23 +173,36 @@
 #     return [{"item_id": 1, "owner": current_user['email']}]
 
 
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from datetime import timedelta
-from passlib.context import CryptContext
 from typing import Optional
+import asyncio
+import hmac
+import logging
 import os
 from dotenv import load_dotenv
-import mysql.connector
-from fastapi.middleware.cors import CORSMiddleware
-from chat.websocket import router as chat_ws_router
-from db import get_db_connection, init_db_schema
-from auth import get_current_active_user, create_access_token, get_user_by_email
 
-# Load environment variables
+# Load environment variables before the app modules below, which read their
+# settings at import time
 load_dotenv()
-init_db_schema()
+
+import mysql.connector
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+from chat.websocket import router as chat_ws_router, manager as chat_manager
+from chat.writer import message_writer
+from chat.receipts import read_receipts
+from chat.outbound import outbound_stats
+from db import get_pool, run_db, shutdown_db
+from schema import check_schema
+from auth import get_current_active_user, create_access_token, token_cache_stats
+from users import create_user, get_user_credentials, user_cache_stats
+from hashing import get_password_hash, verify_password, start_hasher, stop_hasher, hash_stats
+import metrics
+from timing import ServerTimingMiddleware
+from codec import CodecJSONResponse
 
 # Validate required environment variables
 # required_env_vars = [
@@ -206,11 +219,14 @@ if missing_vars:
 
 # Configuration
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+# Seconds the startup schema version check may take before it is skipped
+SCHEMA_CHECK_TIMEOUT = float(os.getenv("SCHEMA_CHECK_TIMEOUT", 10))
+# Bearer token Prometheus must send to scrape /metrics; unset, /metrics is off
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 # FastAPI app and security
-app = FastAPI()
+app = FastAPI(default_response_class=CodecJSONResponse)
 app.include_router(chat_ws_router)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 origins = [
     "http://localhost:3000",  # local
@@ -224,6 +240,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so its total covers everything below it
+app.add_middleware(ServerTimingMiddleware)
 
 # Pydantic models
 class User(BaseModel):
@@ -235,15 +253,9 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-def authenticate_user(email: str, password: str):
-    user = get_user_by_email(email)
-    if not user or not verify_password(password, user['hashed_password']):
+async def authenticate_user(email: str, password: str):
+    user = await run_db(get_user_credentials, email)
+    if not user or not await verify_password(password, user['hashed_password']):
         return False
     return user
 
@@ -254,29 +266,20 @@ def home():
 
 @app.post("/register", status_code=status.HTTP_201_CREATED)
 async def register_user(user: User):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     try:
-        cursor.execute(
-            "INSERT INTO users (username, email, hashed_password) VALUES (%s, %s, %s)",
-            (user.username, user.email, hashed_password)
-        )
-        conn.commit()
+        await run_db(create_user, user.username, user.email, hashed_password)
     except mysql.connector.IntegrityError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username or email already exists"
         )
-    finally:
-        cursor.close()
-        conn.close()
     return {"message": "User created successfully"}
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     # Use email instead of username
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -297,6 +300,66 @@ async def read_users_me(current_user: dict = Depends(get_current_active_user)):
 async def read_own_items(current_user: dict = Depends(get_current_active_user)):
     return [{"item_id": 1, "owner": current_user['email']}]
 
+# async so the stats are read on the event loop that mutates them
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not hmac.compare_digest((authorization or "").encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid metrics token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# Stats the modules already keep, read when /metrics is scraped
+metrics.register_stats("coinconnect_ws", chat_manager.stats, "WebSocket connections and outbound queues",
+                       counters=outbound_stats.keys())
+metrics.register_stats("coinconnect_db_pool", lambda: get_pool().stats(), "MySQL connection pool",
+                       counters=("created", "recycled", "invalidated", "timeouts", "checkouts", "wait_seconds"))
+metrics.register_stats("coinconnect_chat_writer", lambda: message_writer.stats, "Chat message group commits",
+                       counters=message_writer.stats.keys())
+metrics.register_stats("coinconnect_read_receipts", lambda: read_receipts.stats, "Read receipt batches",
+                       counters=read_receipts.stats.keys())
+metrics.register_stats("coinconnect_hash", hash_stats, "bcrypt worker pool", counters=("rejected",))
+metrics.register_stats("coinconnect_user_cache", lambda: user_cache_stats()["by_id"], "User cache by id",
+                       counters=("hits", "misses", "evictions"))
+metrics.register_stats("coinconnect_username_search_cache", lambda: user_cache_stats()["username_search"],
+                       "Username search result cache", counters=("hits", "misses", "evictions"))
+metrics.register_stats("coinconnect_token_cache", token_cache_stats, "Verified JWT cache",
+                       counters=("hits", "misses", "evictions"))
+
+@app.on_event("startup")
+async def start_workers():
+    # First, so bcrypt workers fork before any other thread exists
+    await start_hasher()
+    # Schema changes are applied by `python manage.py migrate`, not here;
+    # this only checks the database has caught up with the code
+    try:
+        await asyncio.wait_for(run_db(check_schema), timeout=SCHEMA_CHECK_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.getLogger(__name__).warning(
+            "Schema version check took over %ss; starting without it", SCHEMA_CHECK_TIMEOUT
+        )
+    await chat_manager.start()
+    message_writer.start()
+    read_receipts.start()
+
+@app.on_event("shutdown")
+async def stop_workers():
+    await message_writer.stop()
+    await chat_manager.stop()
+    await read_receipts.stop()
+    shutdown_db()
+    stop_hasher()
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, port=int(os.getenv("PORT", 8001)))
\ No newline at end of file
+    # permessage-deflate for /ws, offered to clients that ask for it. Under the
+    # uvicorn CLI use --ws-per-message-deflate / UVICORN_WS_PER_MESSAGE_DEFLATE.
+    uvicorn.run(
+        app,
+        port=int(os.getenv("PORT", 8001)),
+        ws_per_message_deflate=os.getenv("WS_PER_MESSAGE_DEFLATE", "1") == "1",
+    )
\ No newline at end of file
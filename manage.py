@@ -0,0 +1,48 @@
+# manage.py
+# Maintenance commands, run as `python manage.py <command>`
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from chat.utils import backfill_room_summaries, reconcile_unread_counters
+from schema import current_revision, migrate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CoinConnect maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upgrade = commands.add_parser(
+        "migrate",
+        help="Apply schema migrations; run once per release before starting the app"
+    )
+    upgrade.add_argument("--revision", default="head", help="Target revision (default: head)")
+
+    backfill = commands.add_parser(
+        "backfill-summaries",
+        help="Rebuild chat_room_summary from chat_messages (safe to re-run)"
+    )
+    backfill.add_argument("--batch-size", type=int, default=1000, help="Rooms per transaction")
+
+    reconcile = commands.add_parser(
+        "reconcile-unread",
+        help="Recount user_chat_status.unread_count from chat_messages"
+    )
+    reconcile.add_argument("--batch-size", type=int, default=500, help="Rooms per transaction")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.revision)
+        print(f"Database schema is at {current_revision()}")
+    elif args.command == "backfill-summaries":
+        rooms = backfill_room_summaries(args.batch_size)
+        print(f"Backfilled summaries for {rooms} rooms")
+    elif args.command == "reconcile-unread":
+        changed = reconcile_unread_counters(args.batch_size)
+        print(f"Corrected {changed} unread counters")
+
+
+if __name__ == "__main__":
+    main()
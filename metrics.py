@@ -0,0 +1,234 @@
+# metrics.py
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Minimal Prometheus instrumentation, rendered by GET /metrics in the text
+# exposition format. Recording is a lock plus a few additions so it can stay
+# on in production; anything that already keeps its own stats dict (pool,
+# caches, outbound queues, writer) is read only when /metrics is scraped.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; wide enough for a cache hit up to a slow bcrypt or pool timeout
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics: List["_Metric"] = []
+_collectors: List[Callable[[], Iterable[str]]] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # Report 0 from the start rather than no series at all
+            self.labels()
+        _metrics.append(self)
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in list(self._children.items()):
+            yield from self._render_child(values, child)
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = 'le="%s"' % _format_value(bound)
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+        labels = _format_labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {cumulative}"
+
+
+def register_stats(prefix: str, stats: Callable[[], dict], help: str,
+                   counters: Iterable[str] = ()):
+    """Expose the numeric top-level values of a stats() dict at scrape time.
+
+    Keys listed in `counters` only ever grow and become <prefix>_<key>_total
+    counters; everything else is a gauge. Nested dicts are skipped.
+    """
+    counters = set(counters)
+
+    def collect() -> Iterable[str]:
+        for key, value in stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if key in counters:
+                name, kind = f"{prefix}_{key}_total", "counter"
+            else:
+                name, kind = f"{prefix}_{key}", "gauge"
+            yield f"# HELP {name} {help}: {key}"
+            yield f"# TYPE {name} {kind}"
+            yield f"{name} {_format_value(value)}"
+
+    _collectors.append(collect)
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in list(_metrics):
+        lines.extend(metric.render())
+    for collect in list(_collectors):
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+
+# Shared instruments, recorded where the work happens
+
+db_call_seconds = Histogram(
+    "coinconnect_db_call_seconds",
+    "Time a DB helper ran on the DB executor, by function",
+    ["function"],
+)
+db_executor_wait_seconds = Histogram(
+    "coinconnect_db_executor_wait_seconds",
+    "Time a DB helper waited for a DB executor thread",
+)
+db_call_errors = Counter(
+    "coinconnect_db_call_errors_total",
+    "DB helpers that raised, by function",
+    ["function"],
+)
+db_slow_queries = Counter(
+    "coinconnect_db_slow_queries_total",
+    "Statements slower than DB_SLOW_QUERY_MS, logged or not",
+)
+chat_messages = Counter(
+    "coinconnect_chat_messages_total",
+    "Chat messages saved and broadcast",
+)
+chat_send_seconds = Histogram(
+    "coinconnect_chat_send_seconds",
+    "From receiving a chat message on a socket to publishing it (save included)",
+)
+fanout_seconds = Histogram(
+    "coinconnect_fanout_seconds",
+    "Time to queue one bus event on this worker's sockets, by event kind",
+    ["kind"],
+)
+fanout_frames = Counter(
+    "coinconnect_fanout_frames_total",
+    "Frames queued on sockets by fan-out, by event kind",
+    ["kind"],
+)
+hash_seconds = Histogram(
+    "coinconnect_hash_seconds",
+    "bcrypt hash/verify latency including queueing for a worker process",
+    ["operation"],
+)
+jwt_decode_seconds = Histogram(
+    "coinconnect_jwt_decode_seconds",
+    "jwt.decode time on token cache misses",
+)
+jwt_cache_lookups = Counter(
+    "coinconnect_jwt_cache_lookups_total",
+    "Verified-token cache lookups, by result",
+    ["result"],
+)
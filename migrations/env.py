@@ -0,0 +1,57 @@
+# migrations/env.py
+import os
+import sys
+from logging.config import fileConfig
+from urllib.parse import quote_plus
+
+from alembic import context
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, pool, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+load_dotenv()
+
+config = context.config
+if config.config_file_name is not None and config.attributes.get("configure_logging", True):
+    fileConfig(config.config_file_name)
+
+# DDL waits at most this long for a metadata lock. A migration stuck behind a
+# long transaction then fails fast instead of queueing every query on the
+# table behind it; re-run it when traffic is quieter.
+MIGRATION_LOCK_WAIT_TIMEOUT = int(os.getenv("MIGRATION_LOCK_WAIT_TIMEOUT", 5))
+
+
+def database_url() -> str:
+    return "mysql+pymysql://{user}:{password}@{host}/{name}?charset=utf8mb4".format(
+        user=quote_plus(os.getenv("DB_USER", "")),
+        password=quote_plus(os.getenv("DB_PASSWORD", "")),
+        host=os.getenv("DB_HOST", "localhost"),
+        name=os.getenv("DB_NAME", ""),
+    )
+
+
+def run_migrations_offline():
+    """Print the SQL instead of running it (`alembic upgrade head --sql`)"""
+    context.configure(url=database_url(), literal_binds=True, transaction_per_migration=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    engine = create_engine(database_url(), poolclass=pool.NullPool)
+    with engine.connect() as connection:
+        connection.execute(text(f"SET SESSION lock_wait_timeout = {MIGRATION_LOCK_WAIT_TIMEOUT}"))
+        # That execute autobegan a transaction; left open, Alembic would treat
+        # the connection as externally managed and never commit the last stamp
+        connection.commit()
+        # MySQL commits DDL implicitly; one transaction per migration keeps
+        # alembic_version in step with what actually ran
+        context.configure(connection=connection, transaction_per_migration=True)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
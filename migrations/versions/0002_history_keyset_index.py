@@ -0,0 +1,21 @@
+"""keyset index for chat history
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from migrations.helpers import add_index, drop_index
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keyset pagination of chat history walks (room_id, id)
+    add_index("chat_messages", "idx_room_id", "room_id, id")
+
+
+def downgrade():
+    drop_index("chat_messages", "idx_room_id")
@@ -0,0 +1,72 @@
+"""per-room summary table
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import context, op
+from sqlalchemy import text
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+# Frozen copy of the summary backfill as of this revision; later changes to
+# the app's backfill_room_summaries must not change what this migration does
+BACKFILL = """
+    INSERT INTO chat_room_summary
+        (room_id, last_message_id, last_message_preview, last_message_time, message_count)
+    SELECT agg.room_id, agg.last_id, LEFT(cm.message, 255), cm.created_at, agg.cnt
+    FROM (
+        SELECT room_id, MAX(id) AS last_id, COUNT(*) AS cnt
+        FROM chat_messages
+        WHERE room_id BETWEEN :first AND :last
+        GROUP BY room_id
+    ) agg
+    JOIN chat_messages cm ON cm.id = agg.last_id
+    ON DUPLICATE KEY UPDATE
+        last_message_id = VALUES(last_message_id),
+        last_message_preview = VALUES(last_message_preview),
+        last_message_time = VALUES(last_message_time),
+        message_count = VALUES(message_count)
+"""
+
+
+def upgrade():
+    # Kept current by save_chat_message so the conversation list never has
+    # to scan chat_messages
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS chat_room_summary (
+            room_id INT PRIMARY KEY,
+            last_message_id INT NOT NULL,
+            last_message_preview VARCHAR(255) NOT NULL,
+            last_message_time TIMESTAMP NULL,
+            message_count INT NOT NULL DEFAULT 0,
+            FOREIGN KEY (room_id) REFERENCES chat_rooms(id) ON DELETE CASCADE
+        )
+    """)
+    # Existing rooms would otherwise show an empty conversation list. Each
+    # batch of rooms commits on its own, so live sends never wait on one long
+    # transaction holding every summary row.
+    with op.get_context().autocommit_block():
+        if context.is_offline_mode():
+            op.execute(text(BACKFILL).bindparams(first=0, last=2 ** 31 - 1))
+            return
+        bind = op.get_bind()
+        last_room_id = 0
+        while True:
+            room_ids = [row[0] for row in bind.execute(
+                text("SELECT id FROM chat_rooms WHERE id > :after ORDER BY id LIMIT :limit"),
+                {"after": last_room_id, "limit": BATCH_SIZE},
+            )]
+            if not room_ids:
+                return
+            bind.execute(text(BACKFILL), {"first": room_ids[0], "last": room_ids[-1]})
+            last_room_id = room_ids[-1]
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS chat_room_summary")
@@ -0,0 +1,66 @@
+"""per-user unread counters
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import context, op
+from sqlalchemy import text
+from migrations.helpers import add_column, drop_column
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+# Frozen copies of the unread reconciliation as of this revision; later
+# changes to the app's reconcile_unread_counters must not change this
+# migration. Both participants get a row, even if they never opened the room.
+ADD_STATUS_ROWS = """
+    INSERT IGNORE INTO user_chat_status (user_id, room_id)
+    SELECT user1_id, id FROM chat_rooms WHERE id BETWEEN :first AND :last
+    UNION ALL
+    SELECT user2_id, id FROM chat_rooms WHERE id BETWEEN :first AND :last
+"""
+RECOUNT = """
+    UPDATE user_chat_status ucs
+    SET ucs.unread_count = (
+        SELECT COUNT(*)
+        FROM chat_messages cm
+        WHERE cm.room_id = ucs.room_id
+        AND cm.sender_id != ucs.user_id
+        AND cm.id > ucs.last_read_message_id
+    )
+    WHERE ucs.room_id BETWEEN :first AND :last
+"""
+
+
+def upgrade():
+    # Maintained as messages are saved and read
+    add_column("user_chat_status", "unread_count", "INT NOT NULL DEFAULT 0")
+    # Existing rows start at 0; count them now so unread badges survive the
+    # upgrade. Each statement commits on its own, a batch of rooms at a time;
+    # a deadlock with a live send fails the migration, which is safe to re-run.
+    with op.get_context().autocommit_block():
+        if context.is_offline_mode():
+            for statement in (ADD_STATUS_ROWS, RECOUNT):
+                op.execute(text(statement).bindparams(first=0, last=2 ** 31 - 1))
+            return
+        bind = op.get_bind()
+        last_room_id = 0
+        while True:
+            room_ids = [row[0] for row in bind.execute(
+                text("SELECT id FROM chat_rooms WHERE id > :after ORDER BY id LIMIT :limit"),
+                {"after": last_room_id, "limit": BATCH_SIZE},
+            )]
+            if not room_ids:
+                return
+            for statement in (ADD_STATUS_ROWS, RECOUNT):
+                bind.execute(text(statement), {"first": room_ids[0], "last": room_ids[-1]})
+            last_room_id = room_ids[-1]
+
+
+def downgrade():
+    drop_column("user_chat_status", "unread_count")
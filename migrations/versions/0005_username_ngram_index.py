@@ -0,0 +1,21 @@
+"""ngram FULLTEXT index for username search
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from migrations.helpers import add_fulltext_ngram, drop_index
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Username search; InnoDB updates it as each registration commits
+    add_fulltext_ngram("users", "idx_username_ngram", "username")
+
+
+def downgrade():
+    drop_index("users", "idx_username_ngram")
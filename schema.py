@@ -0,0 +1,84 @@
+# schema.py
+import logging
+import os
+from typing import Optional
+
+import mysql.connector
+from alembic import command
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+
+from db import db_cursor
+
+# The schema is versioned by the Alembic migrations in migrations/ and changed
+# only by `python manage.py migrate`, run once per release before the new
+# code starts. App processes never issue DDL: at startup they read the
+# applied revision from alembic_version and compare it with the newest
+# migration shipped alongside them.
+#
+#   SCHEMA_CHECK   strict  refuse to start on a database that is behind
+#                  warn    log it and start anyway
+#                  off     skip the check
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "strict").lower()
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+
+logger = logging.getLogger(__name__)
+
+
+def alembic_config() -> Config:
+    config = Config(ALEMBIC_INI)
+    # Keep the app's logging setup when migrating from inside Python
+    config.attributes["configure_logging"] = False
+    return config
+
+
+def migrate(revision: str = "head"):
+    """Upgrade the database to `revision` (blocking; runs the DDL)"""
+    command.upgrade(alembic_config(), revision)
+    if revision == "head":
+        current, head = current_revision(), head_revision()
+        if current != head:
+            raise RuntimeError(f"Migrated to head but the database reports {current or 'no revision'}, not {head}")
+
+
+def head_revision() -> Optional[str]:
+    return ScriptDirectory.from_config(alembic_config()).get_current_head()
+
+
+def current_revision() -> Optional[str]:
+    """The revision the database is at, or None if it was never migrated"""
+    try:
+        with db_cursor() as cursor:
+            cursor.execute("SELECT version_num FROM alembic_version LIMIT 1")
+            row = cursor.fetchone()
+    except mysql.connector.Error as e:
+        if e.errno == 1146:  # ER_NO_SUCH_TABLE
+            return None
+        raise
+    return row[0] if row else None
+
+
+def check_schema():
+    """Make sure the database has every migration this code expects"""
+    if SCHEMA_CHECK == "off":
+        return
+    current, head = current_revision(), head_revision()
+    if current == head:
+        return
+
+    script = ScriptDirectory.from_config(alembic_config())
+    known = current is not None and any(rev.revision == current for rev in script.walk_revisions())
+    if current is not None and not known:
+        # Newer code already migrated the database (e.g. mid-deploy); the
+        # migrations are additive, so this release can keep serving
+        logger.warning("Database schema is at %s, newer than this release (%s)", current, head)
+        return
+
+    message = (
+        f"Database schema is at {current or 'no revision'}, this release needs {head}; "
+        "run `python manage.py migrate`"
+    )
+    if SCHEMA_CHECK == "strict":
+        raise RuntimeError(message)
+    logger.warning(message)
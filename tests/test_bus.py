@@ -0,0 +1,193 @@
+# tests/test_bus.py
+"""Cross-worker fan-out through RedisBus, with an in-memory stand-in for Redis.
+
+Each ConnectionManager plays one worker; they share a FakeRedis the way
+workers share a Redis server.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chat.websocket
+import codec
+from chat.bus import RedisBus
+from chat.websocket import ConnectionManager
+
+
+class FakePubSub:
+    """The part of redis.asyncio's PubSub that RedisBus uses"""
+
+    def __init__(self, server):
+        self._server = server
+        self._messages = asyncio.Queue()
+        self.channels = set()
+
+    async def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    async def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return await asyncio.wait_for(self._messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def aclose(self):
+        self._server.pubsubs.remove(self)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.pubsubs = []
+        self.received = []  # (pubsub, channel) for every delivered message
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        pubsub = FakePubSub(self)
+        self.pubsubs.append(pubsub)
+        return pubsub
+
+    async def publish(self, channel, data):
+        for pubsub in self.pubsubs:
+            if channel in pubsub.channels:
+                self.received.append((pubsub, channel))
+                # redis-py hands channel names back as bytes
+                pubsub._messages.put_nowait({"type": "message", "channel": channel.encode(), "data": data})
+
+    async def aclose(self):
+        pass
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(codec.loads(text))
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        pass
+
+
+async def settle():
+    """Let bus listeners and socket writers run"""
+    for _ in range(20):
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.01)
+
+
+async def start_workers(redis, count=2):
+    workers = [ConnectionManager(bus=RedisBus(client=redis)) for _ in range(count)]
+    for worker in workers:
+        await worker.start()
+    return workers
+
+
+def test_chat_reaches_sockets_on_other_workers():
+    async def scenario():
+        redis = FakeRedis()
+        first, second = await start_workers(redis)
+        alice, bob = FakeWebSocket(), FakeWebSocket()
+        await first.connect_user(alice, 1, 10)
+        await second.connect_user(bob, 2, 10)
+
+        await first.broadcast_chat(10, 1, {"id": 5, "roomId": 10, "message": "hi"})
+        await settle()
+
+        assert [frame["isMe"] for frame in alice.sent] == [True]
+        assert [frame["isMe"] for frame in bob.sent] == [False]
+        assert bob.sent[0]["message"] == "hi"
+
+        for worker in (first, second):
+            await worker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_workers_only_receive_channels_they_hold_sockets_for():
+    async def scenario():
+        redis = FakeRedis()
+        first, second = await start_workers(redis)
+        await first.connect_user(FakeWebSocket(), 1, 10)
+        websocket = FakeWebSocket()
+        await second.connect_user(websocket, 2, 20)
+
+        await first.broadcast_chat(10, 1, {"id": 5, "roomId": 10, "message": "hi"})
+        await settle()
+        second_pubsub = second.bus._pubsub
+        assert not [channel for pubsub, channel in redis.received if pubsub is second_pubsub]
+
+        # Leaving the last room drops the subscriptions
+        await second.disconnect_user(websocket)
+        assert second_pubsub.channels == set()
+
+        for worker in (first, second):
+            await worker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_unless_in_room_is_decided_by_the_worker_holding_the_sockets():
+    async def scenario():
+        redis = FakeRedis()
+        first, second = await start_workers(redis)
+        bob = FakeWebSocket()
+        await second.connect_user(bob, 2, 10)
+
+        # Bob has room 10 open on the other worker: no notification
+        await first.send_to_user_outside_room(2, 10, {"type": "new_message_notification", "roomId": 10})
+        await settle()
+        assert bob.sent == []
+
+        # For a room Bob does not have open, he is notified
+        await first.send_to_user_outside_room(2, 30, {"type": "new_message_notification", "roomId": 30})
+        await settle()
+        assert [frame["roomId"] for frame in bob.sent] == [30]
+
+        for worker in (first, second):
+            await worker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_notification_count_is_read_only_by_the_worker_that_delivers_it(monkeypatch):
+    counted = []
+
+    def get_unread_count(room_id, user_id):
+        counted.append((room_id, user_id))
+        return 3
+
+    monkeypatch.setattr(chat.websocket, "get_unread_count", get_unread_count)
+
+    async def scenario():
+        redis = FakeRedis()
+        first, second = await start_workers(redis)
+        bob = FakeWebSocket()
+        await second.connect_user(bob, 2, 10)
+        notification = {"type": "new_message_notification", "fromUserId": 1, "message": "hi"}
+
+        # In the room on the other worker: dropped there, without a count
+        await first.notify_new_message(2, 10, {**notification, "roomId": 10})
+        await settle()
+        assert bob.sent == [] and counted == []
+
+        await first.notify_new_message(2, 30, {**notification, "roomId": 30})
+        await settle()
+        assert [(frame["roomId"], frame["unreadCount"]) for frame in bob.sent] == [(30, 3)]
+        assert counted == [(30, 2)]
+
+        for worker in (first, second):
+            await worker.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,140 @@
+# timing.py
+import contextvars
+import hmac
+import logging
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+# Per-request stage timing. ServerTimingMiddleware starts a collector for a
+# sampled share of HTTP requests; span() blocks inside it (JWT decode, DB
+# helpers, bcrypt, response encoding) add up their time per stage name. The
+# breakdown is logged for a sample of requests plus every slow one. It only
+# goes out as a Server-Timing header to callers that are trusted with it: the
+# stages reveal internals (e.g. whether /token ran a bcrypt verify, i.e.
+# whether the email exists).
+#
+#   TIMING_SAMPLE_RATE   share of requests timed at all (0 turns it off)
+#   TIMING_HEADER        send Server-Timing on every timed request; for
+#                        local or internal deployments only
+#   TIMING_HEADER_TOKEN  send it to requests carrying this X-Timing-Token
+#   TIMING_LOG_RATE      share of timed requests that are logged
+#   TIMING_LOG_SLOW_MS   timed requests at least this slow are always logged
+TIMING_SAMPLE_RATE = float(os.getenv("TIMING_SAMPLE_RATE", 1.0))
+TIMING_HEADER = os.getenv("TIMING_HEADER", "false").lower() in ("1", "true", "yes")
+TIMING_HEADER_TOKEN = os.getenv("TIMING_HEADER_TOKEN", "")
+TIMING_LOG_RATE = float(os.getenv("TIMING_LOG_RATE", 0.01))
+TIMING_LOG_SLOW_MS = float(os.getenv("TIMING_LOG_SLOW_MS", 500))
+
+logger = logging.getLogger("timing")
+
+# stage name -> [total seconds, count], for the request or socket setup in progress
+_spans: contextvars.ContextVar[Optional[Dict[str, List[float]]]] = contextvars.ContextVar("spans", default=None)
+
+
+class span:
+    """Add the time spent in the block to `name`; free when nothing is collecting"""
+
+    __slots__ = ("name", "_spans", "_started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._spans = _spans.get()
+        if self._spans is not None:
+            self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self._spans is not None:
+            entry = self._spans.setdefault(self.name, [0.0, 0])
+            entry[0] += time.perf_counter() - self._started
+            entry[1] += 1
+
+
+def start(sample_rate: float = None) -> Optional[contextvars.Token]:
+    """Start collecting spans in this context if it is sampled; pass the result to finish()"""
+    rate = TIMING_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return None
+    return _spans.set({})
+
+
+def finish(token: Optional[contextvars.Token]) -> Optional[Dict[str, List[float]]]:
+    """Stop collecting and return what was collected"""
+    if token is None:
+        return None
+    spans = _spans.get()
+    _spans.reset(token)
+    return spans
+
+
+def server_timing(spans: Dict[str, List[float]], total: float) -> str:
+    parts = [f"{name};dur={seconds * 1000:.2f}" for name, (seconds, _) in spans.items()]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def log(event: str, spans: Dict[str, List[float]], total: float, **fields):
+    """Log a timed request or socket setup if it is sampled or slow"""
+    total_ms = total * 1000
+    if total_ms < TIMING_LOG_SLOW_MS and random.random() >= TIMING_LOG_RATE:
+        return
+    stages = {name: round(seconds * 1000, 3) for name, (seconds, _) in spans.items()}
+    logger.info(
+        "%s %.1fms %s %s", event, total_ms,
+        " ".join(f"{key}={value}" for key, value in fields.items()),
+        " ".join(f"{name}={ms}" for name, ms in stages.items()),
+        extra={"event": event, "total_ms": round(total_ms, 3), "stages": stages, **fields},
+    )
+
+
+def _header_allowed(scope) -> bool:
+    if TIMING_HEADER:
+        return True
+    if not TIMING_HEADER_TOKEN:
+        return False
+    for name, value in scope.get("headers", ()):
+        if name == b"x-timing-token":
+            return hmac.compare_digest(value, TIMING_HEADER_TOKEN.encode())
+    return False
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware timing HTTP requests; WebSockets time their own setup"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        token = start()
+        if token is None:
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        spans = _spans.get()
+        status = None
+        send_header = _header_allowed(scope)
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if send_header:
+                    value = server_timing(spans, time.perf_counter() - started)
+                    message = {**message, "headers": [
+                        *message.get("headers", []), (b"server-timing", value.encode("latin-1"))
+                    ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            finish(token)
+            log("http", spans, time.perf_counter() - started,
+                method=scope["method"], path=scope["path"], status=status)
@@ -0,0 +1,149 @@
+# users.py
+import os
+from typing import Dict, List, Optional
+from cache import TTLCache
+from db import db_cursor
+
+# Everything callers need about a user; hashed_password is only ever read by
+# get_user_credentials and never cached.
+USER_COLUMNS = "id, username, email, disabled, created_at"
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+_users_by_id = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_ids_by_email = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Search-box results per (lowercased query, limit). Kept briefly since every
+# keystroke is a query; registrations and disables clear it on this worker.
+USERNAME_SEARCH_TTL = float(os.getenv("USERNAME_SEARCH_TTL", 10))
+USERNAME_SEARCH_CACHE_SIZE = int(os.getenv("USERNAME_SEARCH_CACHE_SIZE", 2000))
+# Must match the server's ngram_token_size, which idx_username_ngram is built with
+NGRAM_TOKEN_SIZE = int(os.getenv("NGRAM_TOKEN_SIZE", 2))
+
+_username_searches = TTLCache(maxsize=USERNAME_SEARCH_CACHE_SIZE, ttl=USERNAME_SEARCH_TTL)
+
+
+def _remember(user: Optional[Dict]) -> Optional[Dict]:
+    if user:
+        _users_by_id.set(user["id"], user)
+        _user_ids_by_email.set(user["email"], user["id"])
+        return dict(user)
+    return None
+
+
+def get_user_by_id(user_id: int) -> Optional[Dict]:
+    user = _users_by_id.get(user_id)
+    if user is not None:
+        return dict(user)
+
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE id = %s", (user_id,))
+        return _remember(cursor.fetchone())
+
+
+def get_cached_user_by_email(email: str) -> Optional[Dict]:
+    """Cache-only lookup, lets async callers skip the DB executor on a hit"""
+    user_id = _user_ids_by_email.get(email)
+    if user_id is not None:
+        user = _users_by_id.get(user_id)
+        if user is not None:
+            return dict(user)
+    return None
+
+
+def get_user_by_email(email: str) -> Optional[Dict]:
+    user = get_cached_user_by_email(email)
+    if user is not None:
+        return user
+
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE email = %s", (email,))
+        return _remember(cursor.fetchone())
+
+
+def get_user_credentials(email: str) -> Optional[Dict]:
+    """Uncached lookup including hashed_password, for login only"""
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"SELECT {USER_COLUMNS}, hashed_password FROM users WHERE email = %s", (email,))
+        return cursor.fetchone()
+
+
+
+def _like_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_usernames(query: str, limit: int = 20) -> List[Dict]:
+    """Enabled users whose username contains query, ordered by username.
+
+    The ngram FULLTEXT index finds the candidates for the query as a phrase
+    and LIKE only rechecks those rows, instead of scanning every username.
+    Queries shorter than one ngram can't use it and fall back to a prefix
+    match on the UNIQUE(username) index.
+    """
+    key = (query.lower(), limit)
+    cached = _username_searches.get(key)
+    if cached is not None:
+        return [dict(user) for user in cached]
+
+    with db_cursor(dictionary=True) as cursor:
+        if len(query) >= NGRAM_TOKEN_SIZE:
+            cursor.execute("""
+                SELECT id, username, email
+                FROM users
+                WHERE MATCH(username) AGAINST (%s IN BOOLEAN MODE)
+                  AND username LIKE %s AND disabled = FALSE
+                ORDER BY username
+                LIMIT %s
+            """, ('"%s"' % query.replace('"', " "), f"%{_like_escape(query)}%", limit))
+        else:
+            cursor.execute("""
+                SELECT id, username, email
+                FROM users
+                WHERE username LIKE %s AND disabled = FALSE
+                ORDER BY username
+                LIMIT %s
+            """, (f"{_like_escape(query)}%", limit))
+        users = cursor.fetchall()
+
+    _username_searches.set(key, users)
+    return [dict(user) for user in users]
+
+
+def create_user(username: str, email: str, hashed_password: str) -> int:
+    with db_cursor(commit=True) as cursor:
+        cursor.execute(
+            "INSERT INTO users (username, email, hashed_password) VALUES (%s, %s, %s)",
+            (username, email, hashed_password)
+        )
+        user_id = cursor.lastrowid
+    invalidate_user(user_id=user_id, email=email)
+    _username_searches.clear()
+    return user_id
+
+
+def set_user_disabled(user_id: int, disabled: bool = True):
+    """Enable or disable a user. Other workers pick it up within USER_CACHE_TTL."""
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("UPDATE users SET disabled = %s WHERE id = %s", (disabled, user_id))
+    invalidate_user(user_id=user_id)
+    _username_searches.clear()
+
+
+def invalidate_user(user_id: Optional[int] = None, email: Optional[str] = None):
+    """Drop a user from this process' caches"""
+    if user_id is not None:
+        user = _users_by_id.pop(user_id)
+        if user and not email:
+            email = user["email"]
+    if email:
+        _user_ids_by_email.pop(email)
+
+
+def user_cache_stats() -> Dict:
+    return {
+        "by_id": _users_by_id.stats(),
+        "by_email": _user_ids_by_email.stats(),
+        "username_search": _username_searches.stats(),
+    }